@@ -0,0 +1,251 @@
+"""
+On-disk response cache.
+
+Subreddit listings and Imgur API responses are cached by URL so that runs
+from cron every few minutes don't refetch data that hasn't changed. Each
+caller decides how long a response stays fresh; once it's stale it is
+revalidated with If-None-Match/If-Modified-Since. The cache is bounded in
+size and evicts the least recently used responses first.
+
+The index is kept in memory and written out once, when the process exits
+(or the cache is reconfigured), rather than on every hit and store. A run
+that was killed before then, or overlapped with another, can leave bodies
+the index doesn't know about; those are swept when the cache is loaded.
+
+In offline mode nothing is fetched and cached responses are returned
+regardless of their age.
+"""
+import atexit
+import hashlib
+import heapq
+import json
+import os
+import re
+import threading
+import time
+
+from background.transport import TransportError
+from background.transport import get_transport
+
+DEFAULT_CACHE_DIRECTORY = u"~/.cache/reddit-background"
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+# A body still being written may belong to another run
+DEFAULT_STALE_TMP_AGE = 60 * 60
+
+RE_BODY_FILENAME = re.compile('^[0-9a-f]{40}(\.tmp)?$')
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+class CacheMissError(TransportError):
+    pass
+
+
+class ResponseCache(object):
+    INDEX_FILENAME = 'index.json'
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_size=DEFAULT_MAX_SIZE,
+                 offline=False):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        self.offline = offline
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._size = 0
+        # (used, key) pairs, oldest first; an entry used since it was pushed
+        # is pushed again when it comes up for eviction
+        self._heap = []
+        self._in_heap = set()
+        self._load()
+
+    def __repr__(self):
+        return '<ResponseCache {}, {} entries>'.format(self.directory, len(self.entries))
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, self.INDEX_FILENAME)
+
+    def _body_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load(self):
+        try:
+            with open(self._index_path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+        self._sweep()
+        self._size = sum(e['size'] for e in self.entries.values())
+        self._heap = [(e['used'], key) for key, e in self.entries.items()]
+        heapq.heapify(self._heap)
+        self._in_heap = set(self.entries)
+
+    def _sweep(self):
+        """Delete bodies the index doesn't track and forget entries whose
+        bodies are gone.
+        """
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return
+        now = time.time()
+        present = set()
+        for filename in filenames:
+            if filename in self.entries:
+                present.add(filename)
+                continue
+            if not RE_BODY_FILENAME.match(filename):
+                continue
+            path = self._body_path(filename)
+            try:
+                if filename.endswith('.tmp') \
+                        and now - os.path.getmtime(path) < DEFAULT_STALE_TMP_AGE:
+                    continue
+                os.remove(path)
+            except OSError:
+                pass
+        for key in set(self.entries) - present:
+            del self.entries[key]
+            self._dirty = True
+
+    def _save(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self._index_path)
+        self._dirty = False
+
+    def flush(self):
+        """Write out the index if it changed since it was saved"""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def _read_body(self, key):
+        try:
+            with open(self._body_path(key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _touch(self, key, revalidated=False):
+        with self._lock:
+            entry = self.entries[key]
+            entry['used'] = time.time()
+            if revalidated:
+                entry['fetched'] = entry['used']
+            self._dirty = True
+
+    def _store(self, key, url, response, body):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = self._body_path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, self._body_path(key))
+
+        now = time.time()
+        with self._lock:
+            old_entry = self.entries.get(key)
+            if old_entry is not None:
+                self._size -= old_entry['size']
+            self.entries[key] = {'url': url,
+                                 'fetched': now,
+                                 'used': now,
+                                 'size': len(body),
+                                 'etag': response.getheader('ETag'),
+                                 'last_modified': response.getheader('Last-Modified')}
+            self._size += len(body)
+            if key not in self._in_heap:
+                heapq.heappush(self._heap, (now, key))
+                self._in_heap.add(key)
+            self._evict()
+            self._dirty = True
+
+    def _evict(self):
+        while self._size > self.max_size and self._heap:
+            used, key = heapq.heappop(self._heap)
+            self._in_heap.discard(key)
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            if entry['used'] != used:
+                heapq.heappush(self._heap, (entry['used'], key))
+                self._in_heap.add(key)
+                continue
+            self._size -= entry['size']
+            del self.entries[key]
+            try:
+                os.remove(self._body_path(key))
+            except OSError:
+                pass
+
+    def fetch(self, url, ttl, headers=None):
+        """Return the body for `url`, from the cache if it's younger than
+        `ttl` seconds and from the network otherwise.
+        """
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        with self._lock:
+            entry = self.entries.get(key)
+        body = self._read_body(key) if entry else None
+
+        if body is not None and (self.offline or time.time() - entry['fetched'] < ttl):
+            self._touch(key)
+            return body
+
+        if self.offline:
+            raise CacheMissError('{} is not cached'.format(url))
+
+        request_headers = dict(headers or {})
+        if body is not None:
+            if entry.get('etag'):
+                request_headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                request_headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            with get_transport().request(url, headers=request_headers) as response:
+                if response.status == 304 and body is not None:
+                    response.read()
+                    self._touch(key, revalidated=True)
+                    return body
+                new_body = response.read()
+                if response.status == 200:
+                    self._store(key, url, response, new_body)
+                return new_body
+        except TransportError:
+            # Better a stale response than none at all
+            if body is not None:
+                return body
+            raise
+
+
+def configure(directory=None, max_size=None, offline=False):
+    """Replace the shared cache with one using the given settings."""
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is not None:
+            _CACHE.flush()
+        _CACHE = ResponseCache(directory=directory or DEFAULT_CACHE_DIRECTORY,
+                               max_size=max_size or DEFAULT_MAX_SIZE,
+                               offline=offline)
+    return _CACHE
+
+
+def get_cache():
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = ResponseCache()
+        return _CACHE
+
+
+@atexit.register
+def _flush_cache():
+    with _CACHE_LOCK:
+        if _CACHE is not None:
+            _CACHE.flush()
@@ -1,38 +1,91 @@
 #!/usr/bin/env python
 import json
-import requests
 import os
+import urllib.parse as urlparse
 
 from importlib_resources import read_text
+from background.cache import get_cache
+from background.transport import TransportError
+
+# Imgur image and album metadata practically never changes
+DEFAULT_API_TTL = 7 * 24 * 60 * 60
 
 
 class ImgurWallpaper(object):
+    ALBUM = 'album'
+    GALLERY = 'gallery'
+    DIRECT = 'direct'
+    IMAGE = 'image'
+
     __imgur_credentials = json.loads(read_text('background.resources', 'credentials.json'))
 
     def __init_(self):
         raise NotImplementedError
 
     @classmethod
-    def request_from_api(cls, reddit_url, request_bucket):
-        response = requests.get('{}{}{}'.format(cls.__imgur_credentials['credentials']['endpoint'], request_bucket,
-                                                cls._get_imgur_id(reddit_url)),
-                                headers={'Authorization': 'Client-ID {}'.format(
-                                    cls.__imgur_credentials['credentials']['client_id'])})
-        if response.status_code == 200:
-            return response.json()
-        return None
+    def request_from_api(cls, reddit_url, request_bucket, request_suffix=''):
+        url = '{}{}{}{}'.format(cls.__imgur_credentials['credentials']['endpoint'], request_bucket,
+                                cls._get_imgur_id(reddit_url), request_suffix)
+        headers = {'Authorization': 'Client-ID {}'.format(
+            cls.__imgur_credentials['credentials']['client_id'])}
+        try:
+            return json.loads(get_cache().fetch(url, DEFAULT_API_TTL, headers=headers))
+        except (TransportError, ValueError):
+            return None
+
+    @classmethod
+    def classify(cls, url: str) -> str:
+        """Tell what kind of Imgur link `url` is without touching the network.
+
+        Returns ALBUM for /a/ links, GALLERY for /gallery/ links, DIRECT for
+        image files on i.imgur.com and IMAGE for any other single image page.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path
+        if path.startswith('/a/'):
+            return cls.ALBUM
+        if path.startswith('/gallery/'):
+            return cls.GALLERY
+        if parts.netloc.lower().startswith('i.') and cls._get_imgur_ext(path):
+            return cls.DIRECT
+        return cls.IMAGE
+
+    @classmethod
+    def _with_thumbnail_links(cls, images: list) -> list:
+        for image in images:
+            image['thumbnail_link'] = cls._get_thumbnail_link(image['link'])
+        return images
+
+    @classmethod
+    def resolve(cls, url: str) -> list:
+        """Return the images behind an Imgur link using a single API call.
+
+        Albums use the bulk `album/{id}/images` endpoint rather than loading
+        the whole album, and galleries are resolved with one `gallery/{id}`
+        call whether they turn out to be an album or a single image.
+        """
+        kind = cls.classify(url)
+        if kind == cls.ALBUM:
+            return cls.load_imgur_album(url)
+
+        if kind == cls.GALLERY:
+            json_dict = cls.request_from_api(url, 'gallery/')
+            if not json_dict or not json_dict['success']:
+                return []
+            data = json_dict['data']
+            if data.get('is_album'):
+                return cls._with_thumbnail_links(data.get('images') or [])
+            return cls._with_thumbnail_links([data])
+
+        image = cls.load_from_api(url)
+        return [image] if image else []
 
     @classmethod
     def load_imgur_album(cls, url: str) -> list:
-        result = []
-        json_dict = ImgurWallpaper.request_from_api(url, 'album/')
+        json_dict = ImgurWallpaper.request_from_api(url, 'album/', '/images')
         if json_dict and json_dict['success']:
-            for dicts in json_dict['data']['images']:
-                image_link = dicts['link']
-                dicts['thumbnail_link'] = cls._get_thumbnail_link(image_link)
-                result.append(dicts)
-
-        return result
+            return cls._with_thumbnail_links(json_dict['data'])
+        return []
 
     @classmethod
     def load_from_api(cls, url: str) -> dict:
@@ -45,19 +98,21 @@ class ImgurWallpaper(object):
 
     @classmethod
     def _get_thumbnail_link(cls, url):
-        return '{}{}h.{}'.format(cls._get_baselink(url), cls._get_imgur_ext(url), cls._get_imgur_id(url))
+        # The 't' suffix is Imgur's small thumbnail, at most 160px and
+        # keeping the aspect ratio
+        return 'https://i.imgur.com/{}t.jpg'.format(cls._get_imgur_id(url))
 
     @classmethod
     def _get_imgur_ext(cls, url):
         return os.path.splitext(url)[1]
 
-    @classmethod
-    def _get_baselink(cls, url):
-        return url[url.find(os.path.basename(url))]
-
     @classmethod
     def _get_imgur_id(cls, url) -> str:
-        base = os.path.basename(url)
+        path = urlparse.urlsplit(url).path
+        base = os.path.basename(path.rstrip('/'))
+        if path.startswith('/gallery/') and '-' in base:
+            # Newer gallery links are /gallery/some-title-slug-{id}
+            base = base.rsplit('-', 1)[1]
         if '.' in base:
             index = base.rfind('.')
             return base[:index]
@@ -68,9 +123,7 @@ class ImgurWallpaper(object):
 
     @classmethod
     def is_single_image(cls, url: str) -> bool:
-        if cls.load_from_api(url):
-            return True
-        return False
+        return cls.classify(url) in (cls.DIRECT, cls.IMAGE)
 
 
 def main():
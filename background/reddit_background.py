@@ -22,31 +22,37 @@ AUTHOR
 """
 
 import argparse
+import collections
+import copy
 import datetime
 import fontconfig
-import glob
 import hashlib
+import heapq
+import io
 import json
 import math
-import operator
+import mmap
 import os
 import random
 import re
 import shutil
-import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import urllib.parse as urlparse
+import weakref
 
+from concurrent.futures import FIRST_COMPLETED
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import as_completed
+from concurrent.futures import wait
 from configparser import ConfigParser, NoOptionError
+from background import cache
+from background import transport
 from background.imgur.imgur_loader import ImgurWallpaper
-from urllib.request import HTTPError
-from urllib.request import URLError
-from urllib.request import build_opener
-from urllib.request import urlretrieve
-from urllib.error import HTTPError
+from background.transport import TransportError
 
 # since PIL is not in the standard library, using a try so it isn't necessary for the script
 try:
@@ -55,20 +61,90 @@ try:
 except ImportError:
     pil_available = False
 
-__version__ = '2.1beta'
+# NumPy is optional as well, it only speeds up scoring large candidate pools
+try:
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
+__version__ = '2.2beta'
 
 # Defaults
 DEFAULT_SUBREDDIT_TOKENS = ['{seasonal}']
 DEFAULT_CONFIG_PATH = u"~/.reddit-background.conf"
 DEFAULT_DOWNLOAD_DIRECTORY = u"~/Reddit Backgrounds"
-DEFAULT_USER_AGENT = "Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11"
+DEFAULT_USER_AGENT = transport.DEFAULT_USER_AGENT
 DEFAULT_IMAGE_CHOOSER = 'random'
+DEFAULT_SUBREDDIT_MODE = 'random'
+DEFAULT_ASSIGNMENT = 'independent'
+# Bytes fetched to read an image's real dimensions before downloading it
+DEFAULT_PROBE_SIZE = 32 * 1024
+# Downloads larger than this (in bytes) are abandoned
+DEFAULT_MAX_DOWNLOAD_SIZE = 64 * 1024 * 1024
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DEFAULT_HASH_ALGORITHM = 'blake2b'
+DEFAULT_HASH_CHUNK_SIZE = 1024 * 1024
+# Maximum number of differing dHash bits (out of 64) for two images to count
+# as near-duplicates; 0 turns near-duplicate detection off
+DEFAULT_NEAR_DUPLICATE_DISTANCE = 0
+# Images kept per desktop; the least recently used beyond that are deleted
+DEFAULT_KEEP_IMAGES = 50
+# Passed to PIL when saving fitted and imprinted images
+DEFAULT_JPEG_OPTIONS = {'quality': 85}
+DEFAULT_RESAMPLE_FILTER = 'bicubic'
+RESAMPLE_FILTERS = ('nearest', 'box', 'bilinear', 'hamming', 'bicubic', 'lanczos')
+# Images are first shrunk by an integer factor with reduce() down to this many
+# times the target size, then resampled with the resample filter
+DEFAULT_REDUCING_GAP = 3.0
+# Megabytes of decoded pixels an image may take up while it's fit and
+# imprinted; larger images are left as they are
+DEFAULT_IMAGE_MEMORY_BUDGET = 256
+DEFAULT_FONT_CACHE_FILENAME = u"fonts.json"
+DEFAULT_IMPRINT_FALLBACK_FONT = u"/usr/share/wine/fonts/arial.ttf"
+# fontconfig rewrites its caches (and so touches these directories) whenever
+# fonts are installed or removed
+FONTCONFIG_CACHE_DIRECTORIES = (
+    u"~/.cache/fontconfig",
+    u"~/.fontconfig",
+    u"/var/cache/fontconfig",
+    u"/usr/local/var/cache/fontconfig",
+    u"/opt/homebrew/var/cache/fontconfig",
+)
+# Partial downloads that haven't been resumed for this long are deleted
+DEFAULT_PARTIAL_MAX_AGE = 24 * 60 * 60
 DEFAULT_IMPRINT_SIZE_TOKENS = ['auto', 50, 8, 40]
 DEFAULT_IMPRINT_FONT_TOKENS = ['Arial', 50, '#CCCCCC']
+DEFAULT_INDEX_FILENAME = u".reddit-background-index.json"
+DEFAULT_DOWNLOAD_WORKERS = 4
+DEFAULT_PROCESS_WORKERS = 2
+DEFAULT_LISTING_TTL = 15 * 60
+# Reddit returns at most this many posts per listing page
+DEFAULT_LISTING_PAGE_SIZE = 100
+DEFAULT_SUBREDDIT_LIMIT = 100
+DEFAULT_LISTING_WORKERS = 5
+DEFAULT_POST_TIMEOUT = 30
+# How long (in seconds) a subreddit listing is cached, by 'sort:timeframe'
+# or just 'sort'
+DEFAULT_LISTING_TTLS = {
+    'new': 5 * 60,
+    'rising': 5 * 60,
+    'hot': 15 * 60,
+    'top:hour': 5 * 60,
+    'top:day': 60 * 60,
+    'top:week': 6 * 60 * 60,
+    'top:month': 12 * 60 * 60,
+    'top:year': 24 * 60 * 60,
+    'top:all': 24 * 60 * 60,
+}
 
 # Regexs
 RE_RESOLUTION_DISPLAYS = re.compile("Resolution: (\d+)\sx\s(\d+)")
 RE_TITLE_TAGS = re.compile('\[[^]]*]', flags=re.DOTALL)
+RE_STORED_FILENAME = re.compile('^[0-9a-f]{32}(\.[^.]*)?$')
+# Files named after their titles with one of these are images stored before
+# images were named after their digest
+LEGACY_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff')
 
 # Globals
 _VERBOSITY = 0
@@ -77,13 +153,45 @@ _DOWNLOAD_DIRECTORY = None
 _IMAGE_COUNT = 0
 _OS_HANDLER = None  # Set below...
 _IMAGE_CHOOSER = None
+_SUBREDDIT_MODE = None
+_ASSIGNMENT = None
+_PROBE_IMAGES = True
 _IMAGE_SCALING = None
+_DOWNLOAD_WORKERS = None
+_PROCESS_WORKERS = None
+_HTTP_TIMEOUT = None
+_HTTP_CONNECTIONS_PER_HOST = None
+_OFFLINE = False
+_LISTING_WORKERS = None
+_POST_TIMEOUT = None
+_LISTING_DEADLINE = None
+_MAX_AGE = None
+_MIN_SCORE = None
+_CACHE_DIRECTORY = None
+_MAX_DOWNLOAD_SIZE = None
+_HASH_ALGORITHM = None
+_NEAR_DUPLICATE_DISTANCE = None
+_KEEP_IMAGES = None
+_JPEG_OPTIONS = {}
+_RESAMPLE_FILTER = None
+_IMAGE_MEMORY_BUDGET = None
+_FONT_RESOLVER = None
+_FONT_RESOLVER_LOCK = threading.Lock()
+_TEXT_LAYOUTS = weakref.WeakKeyDictionary()
+_TEXT_LAYOUTS_LOCK = threading.Lock()
+_MAX_LIBRARY_SIZE = None
+_CACHE_SIZE = None
 
 # Consts
 WEIGHT_ASPECT_RATIO = 1.0
 WEIGHT_RESOLUTION = 1.0
 WEIGHT_JITTER = 0.25
 WEIGHT_REDDIT_SCORE = 1.0
+WEIGHT_FILE_SIZE = 0.0
+WEIGHT_POST_AGE = 0.0
+WEIGHT_NSFW = 0.0
+# A post loses half of its post_age score every week
+POST_AGE_HALF_LIFE = 7 * 24 * 60 * 60
 
 
 def set_verbosity(verbosity):
@@ -136,6 +244,81 @@ def get_image_chooser():
     return _IMAGE_CHOOSER or DEFAULT_IMAGE_CHOOSER
 
 
+def set_subreddit_mode(subreddit_mode):
+    global _SUBREDDIT_MODE
+    _SUBREDDIT_MODE = subreddit_mode
+
+
+def get_subreddit_mode():
+    return _SUBREDDIT_MODE or DEFAULT_SUBREDDIT_MODE
+
+
+def set_listing_workers(listing_workers):
+    global _LISTING_WORKERS
+    _LISTING_WORKERS = listing_workers
+
+
+def get_listing_workers():
+    return max(1, _LISTING_WORKERS or DEFAULT_LISTING_WORKERS)
+
+
+def set_post_timeout(post_timeout):
+    """Seconds to spend resolving the images of a single post"""
+    global _POST_TIMEOUT
+    _POST_TIMEOUT = post_timeout
+
+
+def get_post_timeout():
+    return _POST_TIMEOUT or DEFAULT_POST_TIMEOUT
+
+
+def set_listing_deadline(listing_deadline):
+    """Seconds to spend collecting the images of a whole listing"""
+    global _LISTING_DEADLINE
+    _LISTING_DEADLINE = listing_deadline
+
+
+def get_listing_deadline():
+    return _LISTING_DEADLINE
+
+
+def set_max_age(max_age):
+    """Maximum post age in hours"""
+    global _MAX_AGE
+    _MAX_AGE = max_age
+
+
+def get_max_age():
+    return _MAX_AGE
+
+
+def set_min_score(min_score):
+    global _MIN_SCORE
+    _MIN_SCORE = min_score
+
+
+def get_min_score():
+    return _MIN_SCORE
+
+
+def set_assignment(assignment):
+    global _ASSIGNMENT
+    _ASSIGNMENT = assignment
+
+
+def get_assignment():
+    return _ASSIGNMENT or DEFAULT_ASSIGNMENT
+
+
+def set_probe_images(probe_images):
+    global _PROBE_IMAGES
+    _PROBE_IMAGES = probe_images
+
+
+def get_probe_images():
+    return _PROBE_IMAGES
+
+
 def set_image_scaling(image_scaling):
     global _IMAGE_SCALING
     _IMAGE_SCALING = image_scaling
@@ -145,6 +328,161 @@ def get_image_scaling():
     return _IMAGE_SCALING
 
 
+def set_download_workers(download_workers):
+    global _DOWNLOAD_WORKERS
+    _DOWNLOAD_WORKERS = download_workers
+
+
+def get_download_workers():
+    return max(1, _DOWNLOAD_WORKERS or DEFAULT_DOWNLOAD_WORKERS)
+
+
+def set_process_workers(process_workers):
+    global _PROCESS_WORKERS
+    _PROCESS_WORKERS = process_workers
+
+
+def get_process_workers():
+    return max(1, _PROCESS_WORKERS or DEFAULT_PROCESS_WORKERS)
+
+
+def set_http_timeout(http_timeout):
+    global _HTTP_TIMEOUT
+    _HTTP_TIMEOUT = http_timeout
+
+
+def get_http_timeout():
+    return _HTTP_TIMEOUT or transport.DEFAULT_TIMEOUT
+
+
+def set_http_connections_per_host(connections):
+    global _HTTP_CONNECTIONS_PER_HOST
+    _HTTP_CONNECTIONS_PER_HOST = connections
+
+
+def get_http_connections_per_host():
+    return _HTTP_CONNECTIONS_PER_HOST or transport.DEFAULT_MAX_CONNECTIONS_PER_HOST
+
+
+def set_offline(offline):
+    global _OFFLINE
+    _OFFLINE = offline
+
+
+def get_offline():
+    return _OFFLINE
+
+
+def set_cache_directory(directory):
+    global _CACHE_DIRECTORY
+    _CACHE_DIRECTORY = directory
+
+
+def get_cache_directory():
+    return _CACHE_DIRECTORY or cache.DEFAULT_CACHE_DIRECTORY
+
+
+def set_cache_size(cache_size):
+    """Cache size in megabytes"""
+    global _CACHE_SIZE
+    _CACHE_SIZE = cache_size
+
+
+def get_cache_size():
+    if _CACHE_SIZE:
+        return _CACHE_SIZE * 1024 * 1024
+    return cache.DEFAULT_MAX_SIZE
+
+
+def set_max_download_size(max_download_size):
+    """Maximum image size in megabytes"""
+    global _MAX_DOWNLOAD_SIZE
+    _MAX_DOWNLOAD_SIZE = max_download_size
+
+
+def get_max_download_size():
+    if _MAX_DOWNLOAD_SIZE:
+        return _MAX_DOWNLOAD_SIZE * 1024 * 1024
+    return DEFAULT_MAX_DOWNLOAD_SIZE
+
+
+def set_hash_algorithm(hash_algorithm):
+    global _HASH_ALGORITHM
+    _HASH_ALGORITHM = hash_algorithm
+
+
+def get_hash_algorithm():
+    return _HASH_ALGORITHM or DEFAULT_HASH_ALGORITHM
+
+
+def set_near_duplicate_distance(distance):
+    global _NEAR_DUPLICATE_DISTANCE
+    _NEAR_DUPLICATE_DISTANCE = distance
+
+
+def get_near_duplicate_distance():
+    # Hashing thumbnails needs PIL
+    if not pil_available:
+        return 0
+    if _NEAR_DUPLICATE_DISTANCE is None:
+        return DEFAULT_NEAR_DUPLICATE_DISTANCE
+    return _NEAR_DUPLICATE_DISTANCE
+
+
+def set_keep_images(keep_images):
+    global _KEEP_IMAGES
+    _KEEP_IMAGES = keep_images
+
+
+def get_keep_images():
+    if _KEEP_IMAGES is None:
+        return DEFAULT_KEEP_IMAGES
+    return _KEEP_IMAGES
+
+
+def set_max_library_size(max_library_size):
+    """Maximum size of each desktop's images in megabytes"""
+    global _MAX_LIBRARY_SIZE
+    _MAX_LIBRARY_SIZE = max_library_size
+
+
+def get_max_library_size():
+    if _MAX_LIBRARY_SIZE:
+        return _MAX_LIBRARY_SIZE * 1024 * 1024
+    return None
+
+
+def set_jpeg_option(name, value):
+    _JPEG_OPTIONS[name] = value
+
+
+def get_jpeg_options():
+    options = dict(DEFAULT_JPEG_OPTIONS)
+    options.update(_JPEG_OPTIONS)
+    return options
+
+
+def set_resample_filter(resample_filter):
+    global _RESAMPLE_FILTER
+    _RESAMPLE_FILTER = resample_filter
+
+
+def get_resample_filter():
+    return _RESAMPLE_FILTER or DEFAULT_RESAMPLE_FILTER
+
+
+def set_image_memory_budget(budget):
+    """Memory budget per image in megabytes, 0 for none"""
+    global _IMAGE_MEMORY_BUDGET
+    _IMAGE_MEMORY_BUDGET = budget
+
+
+def get_image_memory_budget():
+    if _IMAGE_MEMORY_BUDGET is None:
+        return DEFAULT_IMAGE_MEMORY_BUDGET * 1024 * 1024
+    return _IMAGE_MEMORY_BUDGET * 1024 * 1024
+
+
 def set_background_setting(setting):
     global _BG_SETTING
     _BG_SETTING = setting
@@ -155,8 +493,28 @@ def get_background_setting():
 
 
 def _safe_makedirs(name, mode=0o777):
-    if not os.path.exists(name):
-        os.makedirs(name, mode=mode)
+    # Download workers may race to create the same directory
+    os.makedirs(name, mode=mode, exist_ok=True)
+
+
+def _new_hash(algorithm=None):
+    return hashlib.new(algorithm or get_hash_algorithm())
+
+
+def _hash_file(path, algorithm=None):
+    """Hash a file in fixed-size chunks of a memory-mapped view so that large
+    images are never read into memory whole.
+    """
+    digest = _new_hash(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        # Empty files can't be mapped
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for offset in range(0, size, DEFAULT_HASH_CHUNK_SIZE):
+                        digest.update(view[offset:offset + DEFAULT_HASH_CHUNK_SIZE])
+    return digest.hexdigest()
 
 
 def warn(msg):
@@ -261,87 +619,277 @@ class ImageChooser(object):
     def __init__(self, desktop, images):
         self.desktop = desktop
         self.images = images
+        self._keys = None
+        self._heap = None
+        self._positions = None
 
-    def sort(self):
+    def rank_keys(self):
+        """Return a ranking key for each image, higher is better."""
         raise NotImplementedError
 
-
-class RandomImageChooser(ImageChooser):
     def sort(self):
-        random.shuffle(self.images)
-
-
-class BestMatchImageChooser(ImageChooser):
+        """Sort the images so that the best images go last."""
+        keys = self.rank_keys()
+        order = sorted(range(len(self.images)), key=keys.__getitem__)
+        self.images[:] = [self.images[i] for i in order]
+
+    def iter_best(self):
+        """Lazily yield the images best first.
+
+        Only the images that are actually consumed are selected: building
+        the heap is O(n) and each image taken costs O(log n), so picking a
+        handful of winners out of a large pool (and moving on to the next
+        one when a download fails) never sorts the whole pool.
+        """
+        self._keys = list(self.rank_keys())
+        self._heap = [(-key, i) for i, key in enumerate(self._keys)]
+        heapq.heapify(self._heap)
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # Unlike a generator this isn't finished for good once it runs dry,
+        # `requeue` can still put an image back
+        if not self._heap:
+            raise StopIteration
+        _, i = heapq.heappop(self._heap)
+        return self.images[i]
+
+    def rescore(self, i):
+        """Return the rank key of image `i` after its dimensions changed."""
+        return self._keys[i]
+
+    def requeue(self, image):
+        """Put an image already handed out by `iter_best` back in line after
+        its dimensions turned out to be different than advertised.
+        """
+        if self._positions is None:
+            self._positions = {id(img): i for i, img in enumerate(self.images)}
+        i = self._positions[id(image)]
+        self._keys[i] = self.rescore(i)
+        heapq.heappush(self._heap, (-self._keys[i], i))
 
-    def _score_reddit_score(self, image, log_lo_score, log_hi_score):
-        """Scoring criteria: The higher the Reddit score, the better the
-        image.
 
-        Since Reddit scores are exponential ('hot' stuff is *much* higher in
-        score than 'cold' stuff), we normalize using the log of the
-        reddit_score.
+class RandomImageChooser(ImageChooser):
+    def rank_keys(self):
+        """Favor images from heavier weighted subreddits.
 
-        0 < score <= 1
+        Every image gets the key random() ** (1 / weight); taking images in
+        order of their keys is weighted random sampling without replacement
+        (the reservoir-sampling scheme of Efraimidis and Spirakis), and with
+        equal weights it's a plain shuffle.
         """
-        log_score = math.log1p(image.raw_reddit_score)
-        if log_hi_score > log_lo_score:
-            score = float(log_score - log_lo_score) / (log_hi_score - log_lo_score)
-        elif log_hi_score == log_lo_score:
-            # Avoid division by zero
-            score = 0.0
-        else:
-            raise AssertionError("log_hi_score shouldn't exceed log_lo_score")
-        log(u"reddit_score={:.2f} score={:.2f}".format(
-            image.reddit_score, score), level=3)
-        return score
-
-    def _score_aspect_ratio(self, image):
-        """Scoring criteria: The closer an image is to the aspect ratio of the
-        desktop the better.
+        return [random.random() ** (1.0 / image.weight) if image.weight > 0 else 0.0
+                for image in self.images]
 
-        0 < score <= 1
-        1 is an exact match in terms of aspect ratio.
-        """
-        image_aspect_ratio = float(image.width) / image.height
-        desktop_aspect_ratio = float(self.desktop.width) / self.desktop.height
 
-        if image_aspect_ratio > desktop_aspect_ratio:
-            score = desktop_aspect_ratio / image_aspect_ratio
-        else:
-            score = image_aspect_ratio / desktop_aspect_ratio
+class ScoringProfile(object):
+    """How a desktop scores candidate images.
 
-        log(u"image_aspect_ratio={:.2f} desktop_aspect_ratio={:.2f} score={:.2f}".format(
-            image_aspect_ratio, desktop_aspect_ratio, score), level=3)
+    A profile is built once per desktop with the desktop's metrics cached.
+    Its weights can be set per desktop, and the cheap criteria that reject an
+    image outright (minimum resolution, aspect ratio band, NSFW) are applied
+    as a pre-filter before any scoring is done.
+    """
+    CRITERIA = ('aspect_ratio', 'resolution', 'reddit_score', 'jitter',
+                'file_size', 'post_age', 'nsfw')
+
+    def __init__(self, width, height):
+        self.aspect_ratio = float(width) / height
+        self.pixels = float(width * height)
+        self.weights = {'aspect_ratio': WEIGHT_ASPECT_RATIO,
+                        'resolution': WEIGHT_RESOLUTION,
+                        'reddit_score': WEIGHT_REDDIT_SCORE,
+                        'jitter': WEIGHT_JITTER,
+                        'file_size': WEIGHT_FILE_SIZE,
+                        'post_age': WEIGHT_POST_AGE,
+                        'nsfw': WEIGHT_NSFW}
+        self.min_width = 0
+        self.min_height = 0
+        self.min_aspect_ratio = None
+        self.max_aspect_ratio = None
+        self.allow_nsfw = True
 
-        return score
+    def __repr__(self):
+        return '<ScoringProfile {}>'.format(self.weights)
 
-    def _score_resolution(self, image):
-        """Scoring criteria: The higher the resolution an image the better.
-        However, an image with resolution higher than the desktop is not
-        better than any other image with resolution better than the desktop.
+    def set_weight_tokens(self, tokens):
+        """Tokens look like 'post_age:0.5'"""
+        for token in tokens:
+            try:
+                name, value = token.split(':')
+                if name not in self.CRITERIA:
+                    raise ValueError(name)
+                self.weights[name] = float(value)
+            except ValueError:
+                log('Invalid scoring weight specified: %s' % token)
+
+    def set_min_resolution(self, value):
+        """Value looks like '1920x1080'"""
+        try:
+            self.min_width, self.min_height = (int(v) for v in value.lower().split('x'))
+        except ValueError:
+            log('Invalid minimum resolution specified: %s' % value)
 
-        0 < score <= 1
-        1 best resolution
-        """
-        image_pixels = image.width * image.height
-        desktop_pixels = self.desktop.width * self.desktop.height
+    def set_aspect_band_tokens(self, tokens):
+        """Tokens are the lowest and highest acceptable aspect ratios"""
+        try:
+            self.min_aspect_ratio, self.max_aspect_ratio = (float(t) for t in tokens)
+        except ValueError:
+            log('Invalid aspect ratio band specified: %s' % ':'.join(tokens))
 
-        if image_pixels > desktop_pixels:
-            score = 1.0
+    @property
+    def active_criteria(self):
+        return [c for c in self.CRITERIA if self.weights[c]]
+
+    def accepts(self, image):
+        if image.width < self.min_width or image.height < self.min_height:
+            return False
+        if self.min_aspect_ratio is not None:
+            aspect_ratio = float(image.width) / image.height
+            if not self.min_aspect_ratio <= aspect_ratio <= self.max_aspect_ratio:
+                return False
+        if image.nsfw and not self.allow_nsfw:
+            return False
+        return True
+
+    def score_dimensions(self, width, height):
+        """Weighted aspect ratio and resolution scores of a single image"""
+        image_aspect_ratio = float(width) / height
+        if image_aspect_ratio > self.aspect_ratio:
+            aspect_ratio = self.aspect_ratio / image_aspect_ratio
         else:
-            score = float(image_pixels) / desktop_pixels
-
-        log(u"image_pixels={:.2f} desktop_pixels={:.2f} score={:.2f}".format(
-            image_pixels, desktop_pixels, score), level=3)
+            aspect_ratio = image_aspect_ratio / self.aspect_ratio
+        resolution = min(width * height / self.pixels, 1.0)
+        return (self.weights['aspect_ratio'] * aspect_ratio,
+                self.weights['resolution'] * resolution)
+
+    def filter(self, images):
+        accepted = [i for i in images if self.accepts(i)]
+        if len(accepted) < len(images):
+            log(u'Filtered out {} of {} candidate images'.format(
+                len(images) - len(accepted), len(images)))
+        return accepted
+
+    def score(self, images):
+        """Score all images in one batch (vectorized with NumPy when it's
+        available).
+
+        Returns a dict mapping each active criterion, plus the overall
+        'score', to a sequence of weighted values in the same order as
+        `images`. The overall score is the mean of the active criteria
+        scaled by the image's subreddit weight.
+        """
+        if numpy_available:
+            return self._score_numpy(images)
+        return self._score_python(images)
+
+    def _score_numpy(self, images):
+        count = len(images)
+
+        def column(getter):
+            return numpy.fromiter((getter(i) for i in images), dtype=float, count=count)
+
+        def normalized_log(values):
+            log_values = numpy.log1p(values)
+            known = ~numpy.isnan(log_values)
+            if not known.any():
+                return numpy.zeros(count)
+            lo = log_values[known].min()
+            hi = log_values[known].max()
+            if hi <= lo:
+                # Avoid division by zero
+                return numpy.zeros(count)
+            return numpy.where(known, (log_values - lo) / (hi - lo), 0.0)
+
+        criteria = self.active_criteria
+        components = {}
+        if 'aspect_ratio' in criteria or 'resolution' in criteria:
+            widths = column(lambda i: i.width)
+            heights = column(lambda i: i.height)
+        if 'aspect_ratio' in criteria:
+            aspect_ratios = widths / heights
+            components['aspect_ratio'] = numpy.where(
+                aspect_ratios > self.aspect_ratio,
+                self.aspect_ratio / aspect_ratios,
+                aspect_ratios / self.aspect_ratio)
+        if 'resolution' in criteria:
+            components['resolution'] = numpy.minimum(widths * heights / self.pixels, 1.0)
+        if 'reddit_score' in criteria:
+            components['reddit_score'] = normalized_log(column(lambda i: i.raw_reddit_score))
+        if 'jitter' in criteria:
+            components['jitter'] = numpy.random.random(count)
+        if 'file_size' in criteria:
+            components['file_size'] = normalized_log(column(
+                lambda i: numpy.nan if i.file_size is None else i.file_size))
+        if 'post_age' in criteria:
+            created = column(lambda i: numpy.nan if i.created_utc is None else i.created_utc)
+            age = numpy.maximum(time.time() - created, 0.0)
+            components['post_age'] = numpy.nan_to_num(0.5 ** (age / POST_AGE_HALF_LIFE))
+        if 'nsfw' in criteria:
+            components['nsfw'] = 1.0 - column(lambda i: bool(i.nsfw))
+
+        for name in components:
+            components[name] = self.weights[name] * components[name]
+        total = sum(components.values()) if components else numpy.zeros(count)
+        components['score'] = column(lambda i: i.weight) * total / max(len(components), 1)
+        return components
+
+    def _score_python(self, images):
+        def normalized_log(values):
+            log_values = [math.log1p(v) if v is not None else None for v in values]
+            known = [v for v in log_values if v is not None]
+            if not known or max(known) <= min(known):
+                # Avoid division by zero
+                return [0.0] * len(values)
+            lo = min(known)
+            spread = max(known) - lo
+            return [(v - lo) / spread if v is not None else 0.0 for v in log_values]
+
+        criteria = self.active_criteria
+        components = {}
+        if 'aspect_ratio' in criteria:
+            scores = []
+            for image in images:
+                image_aspect_ratio = float(image.width) / image.height
+                if image_aspect_ratio > self.aspect_ratio:
+                    scores.append(self.aspect_ratio / image_aspect_ratio)
+                else:
+                    scores.append(image_aspect_ratio / self.aspect_ratio)
+            components['aspect_ratio'] = scores
+        if 'resolution' in criteria:
+            components['resolution'] = [min(i.width * i.height / self.pixels, 1.0)
+                                        for i in images]
+        if 'reddit_score' in criteria:
+            components['reddit_score'] = normalized_log([i.raw_reddit_score for i in images])
+        if 'jitter' in criteria:
+            components['jitter'] = [random.random() for _ in images]
+        if 'file_size' in criteria:
+            components['file_size'] = normalized_log([i.file_size for i in images])
+        if 'post_age' in criteria:
+            now = time.time()
+            components['post_age'] = [
+                0.5 ** (max(now - i.created_utc, 0.0) / POST_AGE_HALF_LIFE)
+                if i.created_utc is not None else 0.0
+                for i in images]
+        if 'nsfw' in criteria:
+            components['nsfw'] = [0.0 if i.nsfw else 1.0 for i in images]
+
+        for name in components:
+            weight = self.weights[name]
+            components[name] = [weight * v for v in components[name]]
+        parts = list(components.values())
+        totals = [sum(values) for values in zip(*parts)] if parts else [0.0] * len(images)
+        components['score'] = [image.weight * total / max(len(parts), 1)
+                               for image, total in zip(images, totals)]
+        return components
 
-        return score
 
-    def _score_jitter(self, image):
-        score = random.random()
-        log(u"jitter score={:.2f}".format(score), level=3)
-        return score
+class BestMatchImageChooser(ImageChooser):
 
-    def sort(self):
+    def score_images(self):
         """
         Image Choosing Algorithm
 
@@ -351,49 +899,67 @@ class BestMatchImageChooser(ImageChooser):
         To handle this we will assign a 'weight' to each image based on some
         criteria and then sort the images by that weight.
 
-        The criteria is as follows:
+        The criteria is as follows (each scores 0 < score <= 1):
 
             1) Aspect ratio: images that are similar in aspect ratio to the
                current desktop are preferred
 
-            2) Resolution: images with higher resolution are preferred
+            2) Resolution: images with higher resolution are preferred, but
+               an image with a higher resolution than the desktop isn't better
+               than any other image that's at least as large as the desktop
 
             3) Jitter: a bit of randomness is added to that successive runs
                produce different results
 
-            4) Reddit Score: images with higher scores on reddit are preferred
+            4) Reddit Score: images with higher scores on reddit are
+               preferred. Since Reddit scores are exponential ('hot' stuff is
+               *much* higher in score than 'cold' stuff), we normalize using
+               the log of the reddit_score.
+
+        Optionally, file size (larger is better, log-normalized like the
+        Reddit score), post age (newer is better) and NSFW (SFW is better)
+        can be weighted in as well. See `ScoringProfile`.
+        """
+        return self.desktop.scoring_profile.score(self.images)
+
+    def rank_keys(self):
+        log('Total candidate images: {}'.format(len(self.images)))
+        if not self.images:
+            return []
 
-        The best images should go last because we treat this like a stack.
+        components = self.score_images()
+        self._components = components
+        scores = components['score']
+        if get_verbosity() >= 2:
+            self._log_score_table(components)
+        if numpy_available:
+            return scores.tolist()
+        return scores
+
+    def rescore(self, i):
+        """Only the aspect ratio and resolution depend on an image's
+        dimensions, so swap those in without rescoring the whole pool.
         """
+        image = self.images[i]
+        components = self._components
+        aspect_ratio, resolution = self.desktop.scoring_profile.score_dimensions(
+            image.width, image.height)
+        delta = 0.0
+        if 'aspect_ratio' in components:
+            delta += aspect_ratio - components['aspect_ratio'][i]
+            components['aspect_ratio'][i] = aspect_ratio
+        if 'resolution' in components:
+            delta += resolution - components['resolution'][i]
+            components['resolution'][i] = resolution
+        criteria_count = max(len(components) - 1, 1)
+        return self._keys[i] + image.weight * delta / criteria_count
+
+    def _log_score_table(self, components):
         images = self.images
-        log('Total candidate images: {}'.format(len(images)))
-
-        raw_reddit_scores = [i.raw_reddit_score for i in images]
-        log_lo_score = math.log1p(min(raw_reddit_scores))
-        log_hi_score = math.log1p(max(raw_reddit_scores))
-
-        # Score each image based on our criteria and their associated weight
-        for image in images:
-            log(u"Score components for '{}'".format(image.display_title), level=3)
-            image.aspect_ratio_score = (
-                    WEIGHT_ASPECT_RATIO * self._score_aspect_ratio(image))
-            image.resolution_score = (
-                    WEIGHT_RESOLUTION * self._score_resolution(image))
-            image.jitter_score = (
-                    WEIGHT_JITTER * self._score_jitter(image))
-            image.reddit_score = (
-                    WEIGHT_REDDIT_SCORE * self._score_reddit_score(
-                image, log_lo_score, log_hi_score))
-            score_parts = [image.aspect_ratio_score,
-                           image.resolution_score,
-                           image.jitter_score,
-                           image.reddit_score]
-            image.score = float(sum(score_parts)) / len(score_parts)
-
-        # Sort so highest scoring images are last
-        images.sort(key=operator.attrgetter('score'))
-
-        # Display score table
+        scores = components['score']
+        order = sorted(range(len(images)), key=scores.__getitem__, reverse=True)
+        zeros = [0.0] * len(images)
+
         log(u"{:>10}{:>10}{:>10}{:>10}{:>10}{:>10} {}".format(
             u"Ranking",
             u"Score",
@@ -404,15 +970,15 @@ class BestMatchImageChooser(ImageChooser):
             u"Title"),
             level=2)
         log(u"=" * 120, level=2)
-        for ranking, image in enumerate(images):
+        for ranking, i in enumerate(order, start=1):
             log(u"{:>10d}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f} {}".format(
-                len(images) - ranking,
-                image.score,
-                image.aspect_ratio_score,
-                image.resolution_score,
-                image.reddit_score,
-                image.jitter_score,
-                image.display_title),
+                ranking,
+                scores[i],
+                components.get('aspect_ratio', zeros)[i],
+                components.get('resolution', zeros)[i],
+                components.get('reddit_score', zeros)[i],
+                components.get('jitter', zeros)[i],
+                images[i].display_title),
                 level=2)
 
 
@@ -480,6 +1046,372 @@ class ImprintConf(object):
         return '\n'.join(ret)
 
 
+def _hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree(object):
+    """A BK-tree of integer hashes under the Hamming distance.
+
+    Every child is filed under its distance to its parent, so by the triangle
+    inequality a search only descends into children whose distance is within
+    `max_distance` of the query's distance to the parent, instead of
+    comparing the query against every hash.
+    """
+
+    def __init__(self):
+        # Nodes are (hash, value, {distance: child})
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key, value):
+        self._size += 1
+        if self._root is None:
+            self._root = (key, value, {})
+            return
+        node = self._root
+        while True:
+            distance = _hamming_distance(key, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (key, value, {})
+                return
+            node = child
+
+    def find(self, key, max_distance):
+        """Return (distance, value) pairs within `max_distance` of `key`,
+        closest first.
+        """
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node_key, value, children = stack.pop()
+            distance = _hamming_distance(key, node_key)
+            if distance <= max_distance:
+                found.append((distance, value))
+            for child_distance, child in children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+class ImageIndex(object):
+    """On-disk index of the images in a download directory.
+
+    Images are stored under the digest they were downloaded with (see
+    `stored_filename`), so an image that's already there is found by name.
+    The index lives in a JSON sidecar inside the directory and maps each
+    filename to the size, mtime, digest (and its algorithm) and title of the
+    file. Files named after their titles, as images were stored before, are
+    renamed the next time the index is refreshed, as are files still as
+    downloaded once `hash_algorithm` changed. Refreshing the index
+    only stats the directory; a file is rehashed only when its size or mtime
+    changed since it was last indexed. Each entry also records when the
+    image was last used, which `prune` evicts by.
+
+    It also remembers which candidates (by image id and normalized URL) each
+    file was downloaded from, so that already seen images can be skipped
+    before any bytes are fetched, and the perceptual hash of each file's
+    thumbnail, so that near-duplicates can be skipped too.
+    """
+    VERSION = 1
+    NAME_LENGTH = 32
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, DEFAULT_INDEX_FILENAME)
+        self.entries = {}
+        self.seen = {}
+        self._dirty = False
+        # Built on first use, guarded by the lock as download workers
+        # search it; files are added to and removed from `entries` under the
+        # same lock since building the tree iterates them
+        self._phash_tree = None
+        self._phash_lock = threading.Lock()
+        self._load()
+
+    def __repr__(self):
+        return '<ImageIndex {}, {} entries>'.format(self.directory, len(self.entries))
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if data.get('version') == self.VERSION:
+            self.entries = data.get('files', {})
+            self.seen = data.get('seen', {})
+
+    def save(self):
+        if not self._dirty:
+            return
+        _safe_makedirs(self.directory)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.VERSION,
+                       'files': self.entries,
+                       'seen': self.seen}, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    @classmethod
+    def stored_filename(cls, digest, ext):
+        """The name an image with the given digest and extension is stored as"""
+        return digest[:cls.NAME_LENGTH] + ext.lower()
+
+    def _set_entry(self, filename, stat, digest):
+        entry = {'size': stat.st_size,
+                 'mtime': stat.st_mtime,
+                 'digest': digest,
+                 'algorithm': get_hash_algorithm()}
+        # Fitting and imprinting change the file but not what it is
+        for key in ('title', 'phash', 'used', 'processed'):
+            value = self.entries.get(filename, {}).get(key)
+            if value:
+                entry[key] = value
+        # Download workers iterate the entries to build the BK-tree
+        with self._phash_lock:
+            self.entries[filename] = entry
+        self._dirty = True
+
+    def _rename(self, old_filename, digest):
+        """Rename a file to its stored name for `digest` and return the new
+        name. An identical file already stored under that name is replaced,
+        keeping what the index knows about it.
+        """
+        _, ext = os.path.splitext(old_filename)
+        filename = self.stored_filename(digest, ext)
+        path = os.path.join(self.directory, filename)
+        log(u"Renaming '{}' to '{}'".format(old_filename, filename), level=2)
+        os.replace(os.path.join(self.directory, old_filename), path)
+
+        with self._phash_lock:
+            entry = self.entries.pop(old_filename, {})
+            entry.update(self.entries.get(filename, {}))
+            self.entries[filename] = entry
+            self._phash_tree = None
+        self._set_entry(filename, os.stat(path), digest)
+        for key, seen_filename in self.seen.items():
+            if seen_filename == old_filename:
+                self.seen[key] = filename
+        return filename
+
+    @staticmethod
+    def _is_legacy(filename):
+        """Whether `filename` is an image named after its title"""
+        return not RE_STORED_FILENAME.match(filename) \
+            and filename.lower().endswith(LEGACY_IMAGE_EXTENSIONS)
+
+    def _migrate(self, path):
+        """Rename a file named after its title to its stored name and return
+        the new name.
+        """
+        old_filename = os.path.basename(path)
+        title, _ = os.path.splitext(old_filename)
+        with self._phash_lock:
+            self.entries.setdefault(old_filename, {}).setdefault('title', title)
+        return self._rename(old_filename, _hash_file(path))
+
+    def _rehash(self, filename):
+        """Hash a file indexed with another algorithm again, renaming it if
+        it's still the file as downloaded, and return its name.
+        """
+        entry = self.entries[filename]
+        path = os.path.join(self.directory, filename)
+        digest = _hash_file(path)
+        if not entry.get('processed') \
+                and entry.get('digest', '')[:self.NAME_LENGTH] == os.path.splitext(filename)[0]:
+            return self._rename(filename, digest)
+        # Fitting or imprinting changed it, there's no telling what the
+        # download hashes to now
+        self._set_entry(filename, os.stat(path), digest)
+        return filename
+
+    def refresh(self):
+        """Bring the index in line with the directory contents."""
+        present = set()
+        legacy = []
+        if os.path.isdir(self.directory):
+            for dir_entry in os.scandir(self.directory):
+                # The sidecar itself and any other dotfiles aren't images
+                if dir_entry.name.startswith('.') or not dir_entry.is_file():
+                    continue
+                if not RE_STORED_FILENAME.match(dir_entry.name):
+                    # Leave anything that isn't an image alone
+                    if self._is_legacy(dir_entry.name):
+                        legacy.append(dir_entry.path)
+                    continue
+                present.add(dir_entry.name)
+                stat = dir_entry.stat()
+                entry = self.entries.get(dir_entry.name)
+                if entry and entry['size'] == stat.st_size \
+                        and entry['mtime'] == stat.st_mtime:
+                    continue
+                log(u"Indexing '{}'".format(dir_entry.name), level=2)
+                self._set_entry(dir_entry.name, stat, _hash_file(dir_entry.path))
+
+        for path in legacy:
+            present.add(self._migrate(path))
+
+        algorithm = get_hash_algorithm()
+        for filename in list(present):
+            if self.entries[filename].get('algorithm', algorithm) != algorithm:
+                log(u"Rehashing '{}' with {}".format(filename, algorithm), level=2)
+                present.discard(filename)
+                present.add(self._rehash(filename))
+
+        for filename in set(self.entries) - present:
+            with self._phash_lock:
+                del self.entries[filename]
+                self._phash_tree = None
+            self._dirty = True
+
+        for key, filename in list(self.seen.items()):
+            if filename not in self.entries:
+                del self.seen[key]
+                self._dirty = True
+
+        self.save()
+
+    def add(self, filename, digest=None, title=None):
+        """Record a file that was just moved into the directory."""
+        path = os.path.join(self.directory, filename)
+        if digest is None:
+            digest = _hash_file(path)
+        self._set_entry(filename, os.stat(path), digest)
+        if title:
+            self.entries[filename]['title'] = title
+        self.save()
+
+    def remember(self, image, filename):
+        """Record that `image` is stored in the directory as `filename`."""
+        for key in image.seen_keys:
+            self.seen[key] = filename
+        if image.phash is not None and 'phash' not in self.entries[filename]:
+            with self._phash_lock:
+                self.entries[filename]['phash'] = '{:016x}'.format(image.phash)
+                if self._phash_tree is not None:
+                    self._phash_tree.add(image.phash, filename)
+        self._dirty = True
+        self.save()
+
+    def find_near_duplicate(self, phash, max_distance):
+        """Return the file whose perceptual hash is closest to `phash`, if
+        it's within `max_distance` bits.
+        """
+        with self._phash_lock:
+            if self._phash_tree is None:
+                self._phash_tree = BKTree()
+                for filename, entry in self.entries.items():
+                    if entry.get('phash'):
+                        self._phash_tree.add(int(entry['phash'], 16), filename)
+            found = self._phash_tree.find(phash, max_distance)
+        for _, filename in found:
+            if filename in self.entries:
+                return filename
+        return None
+
+    def find_seen(self, image):
+        """Return the filename an already seen image is stored as, if any."""
+        for key in image.seen_keys:
+            filename = self.seen.get(key)
+            if filename in self.entries:
+                return filename
+        return None
+
+    def touch(self, filename):
+        """Record that `filename` was used just now."""
+        self.entries[filename]['used'] = time.time()
+        self._dirty = True
+
+    def update_stat(self, filename):
+        """Record the size and mtime of a file that was fitted or imprinted in
+        place, so it isn't rehashed on the next refresh. It keeps its stored
+        name and the digest it was downloaded with.
+        """
+        entry = self.entries.get(filename)
+        if entry is None:
+            return
+        stat = os.stat(os.path.join(self.directory, filename))
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime
+        # Its contents no longer hash to its name
+        entry['processed'] = True
+        self._dirty = True
+
+    def prune(self, max_files=None, max_bytes=None, keep=()):
+        """Delete the least recently used files until at most `max_files`
+        files of at most `max_bytes` in total are left, never deleting those
+        in `keep`, along with partial downloads that were abandoned.
+
+        Files never used (indexed before use was recorded) go first, oldest
+        first.
+        """
+        def last_used(filename):
+            entry = self.entries[filename]
+            return (entry.get('used', 0), entry['mtime'])
+
+        count = len(self.entries)
+        total = sum(entry['size'] for entry in self.entries.values())
+        for filename in sorted(self.entries, key=last_used):
+            if (not max_files or count <= max_files) \
+                    and (not max_bytes or total <= max_bytes):
+                break
+            if filename in keep:
+                continue
+            log(u"Deleting '{}'".format(filename), level=2)
+            _remove_if_exists(os.path.join(self.directory, filename))
+            count -= 1
+            with self._phash_lock:
+                total -= self.entries.pop(filename)['size']
+                self._phash_tree = None
+            self._dirty = True
+
+        for key, filename in list(self.seen.items()):
+            if filename not in self.entries:
+                del self.seen[key]
+                self._dirty = True
+        self.save()
+
+        # Downloads are staged as hidden files, and cancelled or failed ones
+        # are left behind to be resumed
+        if os.path.isdir(self.directory):
+            now = time.time()
+            for dir_entry in os.scandir(self.directory):
+                if dir_entry.name.startswith('.') and dir_entry.is_file() \
+                        and dir_entry.path != self.path \
+                        and now - dir_entry.stat().st_mtime > DEFAULT_PARTIAL_MAX_AGE:
+                    log(u"Deleting '{}'".format(dir_entry.name), level=2)
+                    _remove_if_exists(dir_entry.path)
+
+    def titles(self):
+        """The title of each image in the directory by filename.
+
+        This only reads the index and lists the directory, so nothing is
+        hashed or renamed; images named after their titles and not migrated
+        yet go by their names.
+        """
+        titles = {}
+        if not os.path.isdir(self.directory):
+            return titles
+        for dir_entry in os.scandir(self.directory):
+            filename = dir_entry.name
+            if filename.startswith('.') or not dir_entry.is_file():
+                continue
+            if filename in self.entries:
+                titles[filename] = self.entries[filename].get('title', filename)
+            elif self._is_legacy(filename):
+                titles[filename] = os.path.splitext(filename)[0]
+        return titles
+
+
 class Desktop(object):
     def __init__(self, num, width, height, subreddit_tokens=None):
         self.num = num
@@ -487,13 +1419,9 @@ class Desktop(object):
         self.height = height
         self.subreddit_tokens = subreddit_tokens or []
         self.imprint_conf = ImprintConf()
+        self.scoring_profile = ScoringProfile(width, height)
         self.bg_setting = 'fill'
-
-        # NOTE: we need to get the download-images at instantiation time and
-        # cache the results b/c we'll later clear the download directory
-        # before downloading the new images, meaning we can no longer tell
-        # what's already been downloaded
-        # self.downloaded_images = self._get_downloaded_images()
+        self._image_index = None
 
     def __repr__(self):
         return '<Desktop {}, {}, {}, {}, {}>'.format(self.num, self.width, self.height, self.subreddits, self.imprint_conf)
@@ -502,7 +1430,16 @@ class Desktop(object):
     def subreddits(self):
         return [Subreddit.create_from_token(self, t)
                 for t in self.subreddit_tokens]
-    
+
+    @property
+    def image_index(self):
+        # The download directory can still change while options are being
+        # parsed, so only hang on to an index for the current directory
+        directory = self.download_directory
+        if self._image_index is None or self._image_index.directory != directory:
+            self._image_index = ImageIndex(directory)
+        return self._image_index
+
     @property
     def downloaded_images(self):
         return self._get_downloaded_images()
@@ -514,108 +1451,441 @@ class Desktop(object):
         return os.path.join(get_download_directory(), subdir)
 
     def _get_downloaded_images(self):
-        image_hash = {}
-        if not os.path.exists(self.download_directory):
-            return {}
-        
-        for filename in os.listdir(self.download_directory):
-            full_path = os.path.join(self.download_directory, filename)
-            image_hash[filename] = self.__get_hash(full_path)
+        return self.image_index.titles()
 
-        return image_hash
+    def _download_candidate(self, image, shared_downloads=None, cancel=None):
+        """Download a candidate into the download directory under a hidden
+        name and return (path, digest).
 
-    def __get_hash(self, full_image_path):
-        with open(full_image_path, 'rb') as f:
-            return hashlib.md5(f.read()).hexdigest()
+        The hidden name is derived from the image's URL, so a download that
+        was interrupted (or cancelled through the `cancel` event) is resumed
+        the next time the image is picked.
 
-    def _images_different(self, image):
-        """
-        """
-        # Download to temp directory.
-        path = _download_to_directory(image.url, '/tmp', image.filename)
-        
-        if not image.filename in self.downloaded_images.keys():
-            new_path = '{}/{}'.format(self.download_directory, image.filename)
-            if not os.path.exists(self.download_directory):
-                os.mkdir(self.download_directory)
+        With near-duplicate detection on, the image's thumbnail is hashed
+        first and `NearDuplicateImage` is raised if a similar file is
+        downloaded already.
 
-            shutil.move(path, new_path)
-            return (new_path, False)
-        
-        hash_md5 = self.__get_hash(path)
-        duplicate_not_found = False
-        image_numbers = []
-
-        image_title, ext = os.path.splitext(image.filename)
-        for key_name in self.downloaded_images.keys():
-            key_title, _ = os.path.splitext(key_name)
-            if image_title in key_title:
-                digest_to_comapre = self.downloaded_images[key_name]
-                if not hash_md5 == digest_to_comapre:
-                    log('{} does not equal {} for name {}'.format(hash_md5, digest_to_comapre, image.filename),  level=2)
-                    duplicate_not_found = True
-                    rgx = re.match('.*?([0-9]+)$', key_title)
-                    if rgx:
-                        image_numbers.append(int(rgx.group(1)))
-                    else:
-                        image_numbers.append(0)
+        Unless it was probed already, the first few KB of the image are
+        fetched first and kept as the start of the download; when its real
+        dimensions differ from what the listing advertised,
+        `ImageDimensionsChanged` is raised instead of downloading the rest.
 
-        
-        image_numbers.sort()
-        if duplicate_not_found:
-            digit = image_numbers[-1]
-            new_filename = ''
-            if digit == 0:
-                new_filename = '{}1{}'.format(image_title, ext)
-            else:
-                digit += 1
-                new_filename = '{}{}{}'.format(image_title, digit, ext)
-            
-            new_path = '{}/{}'.format(self.download_directory, new_filename) 
-            shutil.move(path, new_path)
-            return (new_path, True)
-        
-        return ('', False)
+        This runs on the download pool, so it may only search the index and
+        set the image's perceptual hash; the result is handed to
+        `_images_different` on the calling thread.
+        """
+        _, ext = os.path.splitext(image.filename)
+        url_hash = hashlib.md5(image.seen_keys[-1].encode('utf-8')).hexdigest()
+        path = os.path.join(self.download_directory, '.{}{}'.format(url_hash, ext))
+        if shared_downloads is not None:
+            digest = shared_downloads.copy_to(image, path)
+            if digest:
+                return path, digest
+        distance = get_near_duplicate_distance()
+        if distance and image.phash is None:
+            image.phash = _thumbnail_hash(image.thumbnail_url)
+            if image.phash is not None:
+                near_duplicate = self.image_index.find_near_duplicate(image.phash, distance)
+                if near_duplicate:
+                    raise NearDuplicateImage(near_duplicate)
+        if get_probe_images() and not image.probed:
+            probe = _probe_image(image.url, path)
+            if probe:
+                image_format, width, height = probe
+                if (width, height) != (image.width, image.height):
+                    raise ImageDimensionsChanged(image_format, width, height)
+        path, digest = _stream_download(image.url, path,
+                                        max_size=get_max_download_size(),
+                                        cancel=cancel)
+        if shared_downloads is not None:
+            shared_downloads.add(image, path, digest)
+        return path, digest
+
+    def _images_different(self, image, download=None):
+        """Move a download (a (path, digest) pair) into place under its
+        stored name, unless the same file is already there.
+
+        Returns the path of the new file, or '' for a duplicate, which is
+        remembered as seen in the file it duplicates.
+        """
+        if download is None:
+            download = self._download_candidate(image)
+        path, digest = download
+        index = self.image_index
+
+        # Another candidate of this run may have brought in a similar image
+        # while this one was downloading
+        distance = get_near_duplicate_distance()
+        if distance and image.phash is not None:
+            near_duplicate = index.find_near_duplicate(image.phash, distance)
+            if near_duplicate:
+                _discard_download(path)
+                raise NearDuplicateImage(near_duplicate)
+
+        _, ext = os.path.splitext(image.filename)
+        filename = index.stored_filename(digest, ext)
+        if filename in index.entries:
+            index.remember(image, filename)
+            _discard_download(path)
+            return ''
+
+        new_path = os.path.join(self.download_directory, filename)
+        os.replace(path, new_path)
+        index.add(filename, digest, title=image.full_title.strip())
+        index.remember(image, filename)
+        return new_path
+
+    def choose_subreddits(self):
+        """The subreddits this desktop draws candidates from on this run.
+
+        In 'random' mode that's one randomly chosen subreddit, in 'merged'
+        mode it's all of them.
+        """
+        subreddits = self.subreddits
+        if get_subreddit_mode() != 'merged':
+            return [random.choice(subreddits)]
+        return subreddits
 
+    def _gather_candidates(self, subreddits, listings):
+        """Build this desktop's own candidate list out of shared listings.
 
-    def fetch_backgrounds(self, image_count):
-        random_subreddit = random.choice(self.subreddits)
-        images = random_subreddit.fetch_images() 
+        The listings may be shared with other desktops, so the images are
+        copied before they pick up this desktop's weights and scores.
+        """
+        images = []
+        for subreddit in subreddits:
+            for image in listings.get(subreddit.key, ()):
+                image = copy.copy(image)
+                image.weight = subreddit.weight
+                images.append(image)
+        # Even a single listing can hold the same image twice (reposts)
+        return _dedupe_images(images)
+
+    def _post_process(self, image):
+        """Fit and imprint an image in a single decode/encode pass"""
+        transforms = []
+        if get_image_scaling() == 'fit':
+            image._ensure_pil_available('fit')
+            transforms.append(image.fit)
+        if self.imprint_conf.position_tokens:
+            image._ensure_pil_available('imprint_position')
+            transforms.append(image.imprint)
+        if transforms:
+            image.transform(self, transforms)
+
+    def get_chooser(self, subreddits, listings):
+        images = self.scoring_profile.filter(
+            self._gather_candidates(subreddits, listings))
         chooser_cls = _IMAGE_CHOOSER_CLASSES[get_image_chooser()]
-        chooser = chooser_cls(self, images)
-        chooser.sort()
+        return chooser_cls(self, images)
 
+    def fetch_backgrounds(self, image_count, subreddits=None, listings=None,
+                          shared_downloads=None):
+        """Download, fit and imprint the best `image_count` images.
+
+        `listings` maps `Subreddit.key` to already fetched images, letting
+        several desktops share one fetch of the same listing.
+        """
+        if subreddits is None:
+            subreddits = self.choose_subreddits()
+        if listings is None:
+            listings = _fetch_listings(subreddits)
+        chooser = self.get_chooser(subreddits, listings)
+        return self.download_backgrounds(chooser.iter_best(), image_count,
+                                         shared_downloads=shared_downloads,
+                                         requeue=chooser.requeue)
+
+    def download_backgrounds(self, candidates, image_count, shared_downloads=None,
+                             requeue=None):
+        """Download, fit and imprint the first `image_count` of `candidates`
+        that succeed.
+
+        Candidates are downloaded on a pool of `download_workers` threads and
+        post-processed on a separate pool of `process_workers` threads.
+        Downloads are accepted strictly in the order of `candidates`. No more
+        downloads are started than there are images still needed, counting
+        already downloaded candidates that are queued (those take no download
+        slot), and whatever is still queued once enough images succeeded is
+        cancelled. Downloads already in flight are stopped and their partial
+        files kept to be resumed on a later run.
+
+        A candidate whose real dimensions differ from the listing's is
+        checked against the scoring profile's filters again and handed to
+        `requeue` to be ranked anew; without `requeue` it's downloaded in
+        place.
+        """
         log(u'Number of images to download: {0}'.format(image_count))
         result_images = []
-        count = 0
 
-        for image in images:
-            if count >= image_count:
-                break
-            try:
-                # Don't re-use an image that's already downloaded
-                path, result  = self._images_different(image)
-                image.file_path = path
-                if not result:
-                    log(u"'{}' already downloaded, skipping...".format(
-                        image.filename), level=2)
-            except URLOpenError:
-                warn(u"unable to download '{}', skipping...".format(image.url))
-                continue  # Try next image...
-            else:
-                result_images.append(image)
-                if get_image_scaling() == 'fit':
-                    image.fit_to_desktop(self)
-                if self.imprint_conf.position_tokens:
-                    image.imprint_title(self)
-            count += 1
-        return result_images 
+        _safe_makedirs(self.download_directory)
+        index = self.image_index
+        index.refresh()
+
+        download_workers = get_download_workers()
+        download_pool = ThreadPoolExecutor(max_workers=download_workers)
+        process_pool = ThreadPoolExecutor(max_workers=get_process_workers())
+        cancel = threading.Event()
+        candidates = iter(candidates)
+        # (image, future) pairs in ranking order; seen images need no
+        # download and are queued with a future of None
+        pending = collections.deque()
+        # Downloads are staged by URL, so a URL must not be downloaded twice
+        # at once
+        in_flight = set()
+        processing = []
+
+        def submit(image):
+            in_flight.add(image.seen_keys[-1])
+            return download_pool.submit(
+                self._download_candidate, image, shared_downloads, cancel)
+
+        try:
+            while len(result_images) < image_count:
+                downloading = sum(1 for _, future in pending if future is not None)
+                needed = image_count - len(result_images) - (len(pending) - downloading)
+                while downloading < min(download_workers, needed):
+                    image = next(candidates, None)
+                    if image is None:
+                        break
+                    # Images we've already downloaded are reused without
+                    # fetching them again
+                    if index.find_seen(image):
+                        pending.append((image, None))
+                        needed -= 1
+                    elif get_offline():
+                        log(u"'{}' isn't downloaded, skipping while offline...".format(
+                            image.url), level=2)
+                    elif image.seen_keys[-1] in in_flight:
+                        log(u"'{}' is already being downloaded, skipping...".format(
+                            image.url), level=2)
+                    else:
+                        pending.append((image, submit(image)))
+                        downloading += 1
+
+                if not pending:
+                    break
+
+                image, future = pending.popleft()
+                if future is None:
+                    seen_filename = index.find_seen(image)
+                    log(u"'{}' already downloaded as '{}', skipping...".format(
+                        image.url, seen_filename), level=2)
+                    image.file_path = os.path.join(self.download_directory, seen_filename)
+                    result_images.append(image)
+                    continue
+
+                try:
+                    try:
+                        download = future.result()
+                    finally:
+                        in_flight.discard(image.seen_keys[-1])
+                    # Don't re-use an image that's already downloaded
+                    path = self._images_different(image, download)
+                    if not path:
+                        # The same file is downloaded already, use it as is
+                        seen_filename = index.find_seen(image)
+                        log(u"'{}' already downloaded as '{}', skipping...".format(
+                            image.filename, seen_filename), level=2)
+                        image.file_path = os.path.join(self.download_directory, seen_filename)
+                        result_images.append(image)
+                        continue
+                    image.file_path = path
+                except ImageDimensionsChanged as e:
+                    log(u"'{}' is a {}x{} {}, not {}x{}".format(
+                        image.url, e.width, e.height, e.image_format,
+                        image.width, image.height), level=2)
+                    image.width, image.height = e.width, e.height
+                    image.probed = True
+                    if not self.scoring_profile.accepts(image):
+                        log(u"'{}' filtered out after probing, skipping...".format(
+                            image.url), level=2)
+                    elif requeue is not None:
+                        requeue(image)
+                    else:
+                        pending.appendleft((image, submit(image)))
+                    continue
+                except NearDuplicateImage as e:
+                    log(u"'{}' looks like '{}', skipping...".format(
+                        image.url, e.filename), level=2)
+                    continue
+                except URLOpenError:
+                    warn(u"unable to download '{}', skipping...".format(image.url))
+                    continue  # Try next image...
+                else:
+                    result_images.append(image)
+                    processing.append((image, process_pool.submit(self._post_process, image)))
+        finally:
+            # We have enough images, drop whatever is still queued, stop
+            # downloads that are in flight and throw away finished ones
+            cancel.set()
+            for image, future in pending:
+                if future is not None and not future.cancel():
+                    future.add_done_callback(_discard_future_download)
+            download_pool.shutdown(wait=False)
+            process_pool.shutdown(wait=True)
+
+        for image, future in processing:
+            future.result()
+            index.update_stat(os.path.basename(image.file_path))
+
+        for image in result_images:
+            index.touch(os.path.basename(image.file_path))
+        index.save()
+
+        return result_images
+
+    def prune_downloads(self, keep=()):
+        """Trim the download directory down to `keep_images` images and
+        `max_library_size`, deleting the least recently used first.
+        """
+        self.image_index.prune(max_files=get_keep_images(),
+                               max_bytes=get_max_library_size(),
+                               keep=keep)
 
     def set_background(self, image):
         log(u'Setting background for desktop {0}'.format(self.num))
         _OS_HANDLER.set_background(image.file_path, num=self.num, bg_setting=self.bg_setting)
 
 
+class SharedDownloads(object):
+    """Raw downloads kept for the length of a run so that an image picked by
+    more than one desktop is only downloaded once.
+    """
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix='reddit-background-shared-')
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _key(self, image):
+        return image.seen_keys[-1]
+
+    def add(self, image, path, digest):
+        """Keep a copy of a fresh download (a hard link when possible)"""
+        key = self._key(image)
+        shared_path = os.path.join(self.directory, hashlib.md5(key.encode('utf-8')).hexdigest())
+        try:
+            os.link(path, shared_path)
+        except OSError:
+            shutil.copyfile(path, shared_path)
+        with self._lock:
+            self._paths[key] = (shared_path, digest)
+
+    def copy_to(self, image, path):
+        """Copy an image downloaded earlier in the run to `path` and return
+        its digest, or None if it wasn't downloaded yet.
+        """
+        with self._lock:
+            shared = self._paths.get(self._key(image))
+        if shared is None:
+            return None
+        shared_path, digest = shared
+        log(u"Reusing download of '{}'".format(image.url), level=2)
+        _safe_makedirs(os.path.dirname(path))
+        shutil.copyfile(shared_path, path)
+        return digest
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _assign_jointly(plan, listings, image_count):
+    """Choose images for all desktops in one pass.
+
+    Every desktop scores the candidates with its own chooser, then the
+    (score, desktop, image) pairs are assigned greedily, best first, so that
+    no image is given to two desktops while a desktop still has room.
+
+    Returns a list of (desktop, candidates) where each desktop's candidates
+    start with its assigned images, followed by its remaining ranking to fall
+    back on when downloads fail. Images assigned to other desktops come last
+    so a desktop is never left empty when the pool is small.
+    """
+    rankings = []
+    pairs = []
+    for desktop, subreddits in plan:
+        chooser = desktop.get_chooser(subreddits, listings)
+        keys = chooser.rank_keys()
+        ranking = [image for _, image in sorted(
+            zip(keys, chooser.images), key=lambda pair: pair[0], reverse=True)]
+        rankings.append((desktop, ranking))
+        pairs.extend((key, desktop.num, image) for key, image in zip(keys, chooser.images))
+
+    pairs.sort(key=lambda pair: pair[0], reverse=True)
+    assigned = {desktop.num: [] for desktop, _ in plan}
+    taken = set()
+    for _, num, image in pairs:
+        key = image.seen_keys[-1]
+        if key in taken or len(assigned[num]) >= image_count:
+            continue
+        taken.add(key)
+        assigned[num].append(image)
+
+    result = []
+    for desktop, ranking in rankings:
+        mine = assigned[desktop.num]
+        mine_keys = set(i.seen_keys[-1] for i in mine)
+        rest = [i for i in ranking if i.seen_keys[-1] not in mine_keys]
+        result.append((desktop, mine +
+                       [i for i in rest if i.seen_keys[-1] not in taken] +
+                       [i for i in rest if i.seen_keys[-1] in taken]))
+        log(u'Desktop {} assigned: {}'.format(
+            desktop.num, u', '.join(i.display_title for i in mine)), level=2)
+    return result
+
+
+def _fetch_listings(subreddits):
+    """Fetch every distinct listing among `subreddits` once, in parallel.
+
+    Returns a dict mapping `Subreddit.key` to a tuple of images.
+
+    Listings are read to the end before anything is ranked: bestmatch
+    normalizes reddit scores over the whole pool and joint assignment
+    weighs every desktop's candidates against each other, so neither can
+    pick an image until the last page is in.
+    """
+    unique = collections.OrderedDict()
+    for subreddit in subreddits:
+        unique.setdefault(subreddit.key, subreddit)
+    if not unique:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=len(unique)) as pool:
+        fetched = pool.map(lambda s: tuple(s.fetch_images()), unique.values())
+        return dict(zip(unique.keys(), fetched))
+
+
+def _dedupe_images(images):
+    """Drop images posted more than once (crossposts, the same Imgur image
+    in several subreddits), keeping the copy with the best weighted score.
+    """
+    def weighted_score(image):
+        return image.weight * image.raw_reddit_score
+
+    best = {}
+    for image in images:
+        group = [image] + [best[key] for key in image.seen_keys if key in best]
+        winner = max(group, key=weighted_score)
+        for member in group:
+            for key in member.seen_keys:
+                best[key] = winner
+
+    unique = []
+    kept = set()
+    for image in best.values():
+        if id(image) not in kept:
+            kept.add(id(image))
+            unique.append(image)
+    log(u'Unique candidate images: {} of {}'.format(len(unique), len(images)))
+    return unique
+
+
 def _get_desktops_with_defaults():
     """Desktop objects populated with sensible defaults.
 
@@ -636,47 +1906,365 @@ class URLOpenError(Exception):
     pass
 
 
-def _urlopen(url):
-    opener = build_opener()
-    opener.addheaders = [('User-Agent', DEFAULT_USER_AGENT)]
+class DownloadCancelled(URLOpenError):
+    pass
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+class NearDuplicateImage(Exception):
+    def __init__(self, filename):
+        super(NearDuplicateImage, self).__init__(filename)
+        self.filename = filename
+
+
+class ImageDimensionsChanged(Exception):
+    def __init__(self, image_format, width, height):
+        super(ImageDimensionsChanged, self).__init__(image_format, width, height)
+        self.image_format = image_format
+        self.width = width
+        self.height = height
+
+
+def _configure_transport():
+    transport.configure(timeout=get_http_timeout(),
+                        max_connections_per_host=get_http_connections_per_host(),
+                        user_agent=DEFAULT_USER_AGENT)
+
+
+def _configure_cache():
+    cache.configure(directory=get_cache_directory(),
+                    max_size=get_cache_size(),
+                    offline=get_offline())
+
+
+def _parse_image_header(data):
+    """Return (format, width, height) from the first bytes of a JPEG, PNG,
+    GIF or WebP file, or None if they don't tell.
+    """
+    if data.startswith(b'\x89PNG\r\n\x1a\n') and data[12:16] == b'IHDR' \
+            and len(data) >= 24:
+        width, height = struct.unpack('>II', data[16:24])
+        return ('PNG', width, height)
+
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        width, height = struct.unpack('<HH', data[6:10])
+        return ('GIF', width, height)
+
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP' and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b'VP8 ':
+            width, height = struct.unpack('<HH', data[26:30])
+            return ('WEBP', width & 0x3fff, height & 0x3fff)
+        if chunk == b'VP8L':
+            bits = struct.unpack('<I', data[21:25])[0]
+            return ('WEBP', (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1)
+        if chunk == b'VP8X':
+            width = struct.unpack('<I', data[24:27] + b'\x00')[0] + 1
+            height = struct.unpack('<I', data[27:30] + b'\x00')[0] + 1
+            return ('WEBP', width, height)
+        return None
+
+    if data[:2] == b'\xff\xd8':
+        # Walk the JPEG segments until a start-of-frame marker
+        offset = 2
+        while offset + 9 <= len(data):
+            if data[offset] != 0xff:
+                return None
+            marker = data[offset + 1]
+            if marker == 0xff:
+                offset += 1
+                continue
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+                return ('JPEG', width, height)
+            offset += 2 + struct.unpack('>H', data[offset + 2:offset + 4])[0]
+    return None
+
+
+def _dhash(img):
+    """64-bit difference hash of a PIL image: whether each pixel of a 9x8
+    grayscale thumbnail is brighter than its right neighbour.
+    """
+    pixels = list(img.convert('L').resize((9, 8), pilImage.BILINEAR).getdata())
+    phash = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            phash = (phash << 1) | (left > right)
+    return phash
+
+
+def _thumbnail_hash(url):
+    """The dHash of the thumbnail at `url`, or None if there's no usable
+    thumbnail (Reddit uses placeholders like 'default' and 'nsfw').
+    """
+    if not pil_available or not url.startswith(('http://', 'https://')):
+        return None
     try:
-        return opener.open(url)
-    except (socket.error,
-            HTTPError,
-            URLError):
+        with transport.urlopen(url, gzip=False) as response:
+            data = response.read()
+        return _dhash(pilImage.open(io.BytesIO(data)))
+    except (TransportError, IOError, ValueError) as e:
+        log(u"Unable to hash thumbnail '{}': {}".format(url, e), level=2)
+        return None
+
+
+def _probe_image(url, path=None):
+    """Fetch just the start of an image with a Range request and read its
+    real format and dimensions from the header.
+
+    With `path`, the probed bytes are kept as the partial download to
+    `path` so that downloading it picks up after them, and a partial
+    download that's already there is read instead of the network.
+
+    An error status (other than 416 for the range) raises `URLOpenError`,
+    since downloading the whole image would fail the same way.
+    """
+    part_path, validator_path = _part_paths(path) if path else (None, None)
+    if part_path and _read_validator(validator_path) is not None:
+        try:
+            with open(part_path, 'rb') as f:
+                probe = _parse_image_header(f.read(DEFAULT_PROBE_SIZE))
+            if probe:
+                return probe
+        except IOError:
+            pass
+
+    headers = {'Range': 'bytes=0-{}'.format(DEFAULT_PROBE_SIZE - 1)}
+    try:
+        with transport.urlopen(url, headers=headers, gzip=False) as response:
+            data = b''
+            while len(data) < DEFAULT_PROBE_SIZE:
+                chunk = response.read(DEFAULT_PROBE_SIZE - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            if part_path and data and (response.status == 200
+                                       or _resumes_at(response, 0)):
+                _safe_makedirs(os.path.dirname(part_path))
+                with open(part_path, 'wb') as f:
+                    f.write(data)
+                _write_validator(validator_path, response)
+    except transport.HTTPStatusError as e:
+        log(e)
+        if e.status == 416:
+            return None
         raise URLOpenError
+    except TransportError as e:
+        log(e)
+        return None
+    return _parse_image_header(data)
 
 
-def _download_to_directory(url, dirname, filename):
-    """Download a file to a particular directory"""
-    _safe_makedirs(dirname)
+def _resumes_at(response, offset):
+    """Whether `response` is the rest of a file starting at `offset`"""
+    content_range = response.getheader('Content-Range') or ''
+    return response.status == 206 and content_range.startswith('bytes {}-'.format(offset))
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
 
-    path = os.path.join(dirname, filename)
+def _part_paths(path):
+    """The hidden `.part` file a download to `path` is written to, and the
+    file next to it keeping the validator it can be resumed with.
+    """
+    dirname, filename = os.path.split(path)
+    part_path = os.path.join(dirname, '.{}.part'.format(filename))
+    return part_path, part_path + '.json'
+
+
+def _remove_partial(path):
+    """Remove the partial download to `path`, if any"""
+    for partial_path in _part_paths(path):
+        _remove_if_exists(partial_path)
+
+
+def _total_length(response):
+    """The size of the whole file `response` is (part of), if known"""
+    content_range = response.getheader('Content-Range') or ''
+    if response.status == 206:
+        total = content_range.rpartition('/')[2]
+    else:
+        total = response.getheader('Content-Length') or ''
+    return int(total) if total.isdigit() else None
+
+
+def _read_validator(validator_path):
+    """The validator stored for a partial download: a dict with the 'etag'
+    or 'last_modified' to send as If-Range and the file's 'length', if
+    known. None when there's none.
+    """
+    try:
+        with open(validator_path) as f:
+            validator = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(validator, dict) \
+            or not (validator.get('etag') or validator.get('last_modified')):
+        return None
+    return validator
+
+
+def _write_validator(validator_path, response):
+    """Keep the ETag or Last-Modified of a download so a partial file is only
+    ever resumed with the rest of the same file.
+    """
+    etag = response.getheader('ETag')
+    # If-Range only accepts strong ETags
+    if etag and etag.startswith('W/'):
+        etag = None
+    last_modified = response.getheader('Last-Modified')
+    if not etag and not last_modified:
+        _remove_if_exists(validator_path)
+        return
+    with open(validator_path, 'w') as f:
+        json.dump({'etag': etag,
+                   'last_modified': last_modified,
+                   'length': _total_length(response)}, f)
+
+
+def _stream_download(url, path, max_size=None, cancel=None):
+    """Download `url` to `path` and return (path, digest).
+
+    The body is written in chunks to a hidden `.part` file next to `path` and
+    hashed as it's written, then renamed into place, so `path` never holds a
+    partial file. A `.part` file left over by an interrupted download is
+    resumed with a Range request, guarded by If-Range with the ETag or
+    Last-Modified the download started with, so the server sends the whole
+    file again if it changed. Files over `max_size` bytes are abandoned, and
+    setting the `cancel` event stops the download, keeping the partial file
+    to be resumed later.
+    """
+    dirname, filename = os.path.split(path)
+    _safe_makedirs(dirname)
+    part_path, validator_path = _part_paths(path)
+
+    digest = _new_hash()
+    offset = 0
+    validator = None
+    if os.path.exists(part_path):
+        validator = _read_validator(validator_path)
+        if validator is None:
+            # Without a validator there's no telling whether the rest of the
+            # file on the server still goes with what we have
+            _remove_partial(path)
+        else:
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(DEFAULT_DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    offset += len(chunk)
+
+    if offset and offset == validator.get('length'):
+        # The whole file came in already, e.g. a small image while probing
+        if max_size and offset > max_size:
+            _remove_partial(path)
+            log(u"'{0}' is larger than {1} bytes".format(url, max_size))
+            raise URLOpenError
+        os.replace(part_path, path)
+        _remove_if_exists(validator_path)
+        return path, digest.hexdigest()
+
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        headers['If-Range'] = validator.get('etag') or validator['last_modified']
+        log(u"Resuming '{0}' at {1} bytes".format(url, offset))
+    else:
+        log(u"Downloading '{0}' to '{1}'".format(url, path))
 
-    log(u"Downloading '{0}' to '{1}'".format(url, path))
     try:
-        urlretrieve(url, path)
-    except HTTPError as e:
+        # Images are already compressed, asking for gzip would only cost CPU
+        response = transport.urlopen(url, headers=headers, gzip=False)
+    except TransportError as e:
+        if offset and isinstance(e, transport.HTTPStatusError) and e.status == 416:
+            # The partial file is no use against what the server has now
+            _remove_partial(path)
+            return _stream_download(url, path, max_size=max_size, cancel=cancel)
         log(e)
+        raise URLOpenError
+
+    with response:
+        if offset and not _resumes_at(response, offset):
+            log(u"'{0}' can't be resumed, starting over".format(url), level=2)
+            digest = _new_hash()
+            offset = 0
+        if not offset:
+            _write_validator(validator_path, response)
+
+        length = response.getheader('Content-Length')
+        expected = offset + int(length) if length and length.isdigit() else None
+        if max_size and expected is not None and expected > max_size:
+            _remove_partial(path)
+            log(u"'{0}' is larger than {1} bytes".format(url, max_size))
+            raise URLOpenError
+
+        size = offset
+        cancelled = False
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    cancelled = True
+                    break
+                try:
+                    chunk = response.read(DEFAULT_DOWNLOAD_CHUNK_SIZE)
+                except TransportError as e:
+                    # Keep what we have, the next attempt picks up from there
+                    log(e)
+                    raise URLOpenError
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size and size > max_size:
+                    break
+                f.write(chunk)
+                digest.update(chunk)
+
+    if cancelled:
+        # An empty partial file isn't worth resuming
+        if not size:
+            _remove_partial(path)
+        raise DownloadCancelled
+
+    if max_size and size > max_size:
+        _remove_partial(path)
+        log(u"'{0}' is larger than {1} bytes".format(url, max_size))
+        raise URLOpenError
+
+    # http.client treats a connection closed early as the end of the body
+    if expected is not None and size != expected:
+        log(u"'{0}' was cut off at {1} of {2} bytes".format(url, size, expected))
+        raise URLOpenError
+
+    os.replace(part_path, path)
+    _remove_if_exists(validator_path)
+    return path, digest.hexdigest()
 
-    op=open(path)
-    op.close()
+
+def _download_to_directory(url, dirname, filename):
+    """Download a file to a particular directory"""
+    path, _ = _stream_download(url, os.path.join(dirname, filename),
+                               max_size=get_max_download_size())
     return path
 
 
-def _clear_download_directory(desktops):
-    dirname = get_download_directory()
-    # check contents of download dir
-    if os.path.exists(dirname):
-        folders = os.listdir(dirname)
-        if len(folders) == len(desktops):
-            for f in folders:
-                files = glob.glob('{}/{}/*'.format(dirname, f))
-                for fs in files:
-                    os.remove(fs)
-        else:
-            shutil.rmtree(dirname)
-            _safe_makedirs(dirname)
+def _discard_download(path):
+    """Remove a download that wasn't used"""
+    _remove_if_exists(path)
+
+
+def _discard_future_download(future):
+    if not future.cancelled() and future.exception() is None:
+        path, _ = future.result()
+        _discard_download(path)
 
 
 def _get_northern_hemisphere_season():
@@ -695,6 +2283,17 @@ def _get_northern_hemisphere_season():
         return 'winter'
 
 
+def _normalize_url(url):
+    """Normalize an image URL so that the same image is recognized across
+    runs: the scheme is forced to https, the host is lowercased and the
+    query string (which carries expiring signatures on Reddit previews) is
+    dropped.
+    """
+    parts = urlparse.urlsplit(url)
+    return urlparse.urlunsplit(('https', parts.netloc.lower(),
+                                parts.path.rstrip('/'), '', ''))
+
+
 def slugify(value):
     """
     Normalizes string, converts to lowercase, removes non-alpha characters,
@@ -719,7 +2318,11 @@ class Image(object):
                  resolution_score=0.0,
                  jitter_score=0.0,
                  reddit_score=0.0,
-                 image_id=None):
+                 image_id=None,
+                 weight=1.0,
+                 created_utc=None,
+                 nsfw=False,
+                 file_size=None):
         self.width = width
         self.height = height
         self._url = url
@@ -732,6 +2335,12 @@ class Image(object):
         self.jitter_score = jitter_score
         self.reddit_score = reddit_score
         self.image_id = image_id
+        self.weight = weight
+        self.created_utc = created_utc
+        self.nsfw = nsfw
+        self.file_size = file_size
+        self.probed = False
+        self.phash = None
         self.file_path = None
 
     @property
@@ -742,6 +2351,14 @@ class Image(object):
     def thumbnail_url(self):
         return self._thumbnail_url.replace('amp;', '')
 
+    @property
+    def seen_keys(self):
+        """Keys used to recognize this image in an `ImageIndex`."""
+        keys = [u'url:' + _normalize_url(self.url)]
+        if self.image_id:
+            keys.insert(0, u'id:' + self.image_id)
+        return keys
+
     @property
     def display_title(self):
         if len(self.title) <= self.TITLE_MAX_LENGTH:
@@ -773,78 +2390,90 @@ class Image(object):
                               u" Please install `pillow` or remove the '%s'"
                               u" option from your config." % option)
 
-    def fit_to_desktop(self, desktop):
-        self._ensure_pil_available('fit')
+    def get_path(self, desktop):
         if self.file_path:
-            img = pilImage.open(self.file_path)
-        else:
-            img = pilImage.open(os.path.join(desktop.download_directory, self.filename))
+            return self.file_path
+        return os.path.join(desktop.download_directory, self.filename)
 
+    def transform(self, desktop, transforms):
+        """Decode the image once, run it through `transforms` and encode it
+        once, replacing the file.
 
+        A transform takes a PIL image and the desktop and returns a PIL
+        image; returning the image it was given means there was nothing to
+        do, and if none of the transforms did anything the file is left
+        alone.
+        """
+        path = self.get_path(desktop)
+        dirname, filename = os.path.split(path)
+        tmp_path = os.path.join(dirname, '.{}.tmp'.format(filename))
+        with pilImage.open(path) as source:
+            img = source
+            try:
+                for transform in transforms:
+                    img = transform(img, desktop)
+            except ImageTooLarge:
+                warn(u"'{}' is too large for image_memory_budget, leaving it as is".format(
+                    self.full_title))
+                return
+            if img is source:
+                return
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.save(tmp_path, "JPEG", **get_jpeg_options())
+        os.replace(tmp_path, path)
+        self.width = img.width
+        self.height = img.height
+
+    def _check_memory_budget(self, img):
+        """Raise `ImageTooLarge` before decoding an image that would take up
+        more than the memory budget (counting 4 bytes a pixel, as imprinting
+        works in RGBA).
+        """
+        budget = get_image_memory_budget()
+        if budget and img.width * img.height * 4 > budget:
+            raise ImageTooLarge
+
+    def fit(self, img, desktop):
+        """Transform that scales the image to fit the desktop, letterboxing
+        it in black.
+        """
         image_ratio = float(img.width) / float(img.height)
         desktop_ratio = float(desktop.width) / float(desktop.height)
         if image_ratio == desktop_ratio:
             # If exact match, then no resize necessary...
-            return
+            return img
         elif image_ratio < desktop_ratio:
-            img = img.resize((int(desktop.height * image_ratio), desktop.height))
+            size = (int(desktop.height * image_ratio), desktop.height)
         else:
-            img = img.resize((desktop.width, int(desktop.width / image_ratio)))
+            size = (desktop.width, int(desktop.width / image_ratio))
+        # Have libjpeg scale the image down by up to 8x as it's decoded,
+        # which keeps it at least as large as `size`
+        if img.format == 'JPEG':
+            img.draft(img.mode, size)
+        self._check_memory_budget(img)
+        img = img.resize(size,
+                         getattr(pilImage, get_resample_filter().upper()),
+                         reducing_gap=DEFAULT_REDUCING_GAP)
         canvas = pilImage.new('RGB', (desktop.width, desktop.height), (0, 0, 0))
         canvas.paste(img, (max(0, int((desktop.width - img.width) / 2.0)),
                            max(0, int((desktop.height - img.height) / 2.0))))
-        img = canvas
-        if self.file_path:
-            img.save(self.file_path, "JPEG", quality=85)
-        else:
-            img.save(os.path.join(desktop.download_directory, self.filename),
-                 "JPEG", quality=85)
-        self.width = img.width
-        self.height = img.height
+        return canvas
 
-    def _wrap_text(self, draw, text, maxwidth, font):
-        """Split text into lines that are less than maxwidth for a given PIL
-        font
-        """
-        lines = []
-        for tl in text.splitlines():
-            curparts = []
-            for part in (t for t in tl.split() if t):
-                curparts.append(part)
-                if draw.textsize(u' '.join(curparts), font=font)[0] > maxwidth:
-                    if len(curparts) == 1:
-                        lines.append(u' '.join(curparts))
-                        curparts = []
-                    else:
-                        lines.append(u' '.join(curparts[:-1]))
-                        curparts = [curparts[-1]]
-            if len(curparts) > 0:
-                lines.append(u' '.join(curparts))
-        return lines
+    def fit_to_desktop(self, desktop):
+        self._ensure_pil_available('fit')
+        self.transform(desktop, [self.fit])
 
-    def _get_imprint_font(self, desktop, default='/usr/share/wine/fonts/arial.ttf'):
+    def _get_imprint_font(self, desktop, default=DEFAULT_IMPRINT_FALLBACK_FONT):
         conf = desktop.imprint_conf
-        fonts = fontconfig.query(lang='en')
-        try:
-            for f in fonts:
-                if conf.font_filename in f:
-                    break 
-
-            font = pilImageFont.truetype(f, conf.font_size)
-        except IOError:
-            warn("Cannot open font file {}.".format(conf.font_filename))
-            font = pilImageFont.truetype(default, conf.font_size)
-        return font
-
-    def imprint_title(self, desktop):
-        self._ensure_pil_available('imprint_position')
+        return get_font_resolver().get_font(conf.font_filename, conf.font_size,
+                                            default=default)
 
+    def imprint(self, img, desktop):
+        """Transform that draws the title in a translucent box."""
         if not self.full_title:
-            return
-
-        img = pilImage.open(os.path.join(desktop.download_directory, self.filename))
-
-        draw = pilImageDraw.ImageDraw(img)
+            return img
+        self._check_memory_budget(img)
 
         conf = desktop.imprint_conf
 
@@ -854,13 +2483,16 @@ class Image(object):
             maxwidth = int(conf.box_width)
 
         font = self._get_imprint_font(desktop)
+        layout = get_text_layout(font)
 
-        lines = self._wrap_text(draw, self.full_title, maxwidth, font)
+        lines = layout.wrap(self.full_title, maxwidth)
+        if not lines:
+            return img
 
         # Compute box height and width
-        maxwidth = max(draw.textsize(l, font=font)[0] for l in lines)
+        maxwidth = max(width for _, width in lines)
 
-        lineheight = draw.textsize(self.title, font=font)[1]
+        lineheight = layout.line_height
         maxheight = len(lines) * lineheight
 
         # Calculate the x and y
@@ -877,75 +2509,357 @@ class Image(object):
         else:
             y = max(conf.margin, (img.height - maxheight) / 2)
 
-        # Draw the background box with transparent color, then composite with
-        # the original image
-        canvas = pilImage.new('RGBA', img.size)
-        draw = pilImageDraw.ImageDraw(canvas)
-
-        box_x0 = x - conf.padding
-        box_y0 = y - conf.padding
-        box_x1 = x + maxwidth + conf.padding
-        box_y1 = y + maxheight + conf.padding
+        box = (x - conf.padding,
+               y - conf.padding,
+               x + maxwidth + conf.padding,
+               y + maxheight + conf.padding)
         box_fill = (0, 0, 0, int(255 * conf.transparency / 100.0))
-        draw.rectangle((box_x0, box_y0, box_x1, box_y1), fill=box_fill)
-        img = pilImage.alpha_composite(img.convert('RGBA'), canvas)
-
-        # Draw the text
-        draw = pilImageDraw.ImageDraw(img)
-        text_x = x
-        text_y = y
         text_fill = pilImageColor.getrgb(conf.font_color)
         if len(text_fill) != 3:
             text_fill = (255, 229, 204)
-        for line in lines:
-            draw.text((text_x, text_y), line, font=font, fill=text_fill)
-            text_y += lineheight
+        positions = [(x, y + i * lineheight) for i in range(len(lines))]
+
+        # Only the box and the text change, so only the region they cover is
+        # converted to RGBA and composited (glyphs may overhang the box)
+        bounds = [box]
+        for (text_x, text_y), (line, _) in zip(positions, lines):
+            x0, y0, x1, y1 = font.getbbox(line)
+            bounds.append((text_x + x0, text_y + y0, text_x + x1, text_y + y1))
+        left = max(0, int(math.floor(min(b[0] for b in bounds))))
+        top = max(0, int(math.floor(min(b[1] for b in bounds))))
+        right = min(img.width, int(math.ceil(max(b[2] for b in bounds))) + 1)
+        bottom = min(img.height, int(math.ceil(max(b[3] for b in bounds))) + 1)
+        if left >= right or top >= bottom:
+            return img
 
-        # Save the image
+        # Draw the background box with transparent color, then composite with
+        # the original image
+        region = img.crop((left, top, right, bottom)).convert('RGBA')
+        overlay = pilImage.new('RGBA', region.size)
+        draw = pilImageDraw.ImageDraw(overlay)
+        draw.rectangle((box[0] - left, box[1] - top, box[2] - left, box[3] - top),
+                       fill=box_fill)
+        region = pilImage.alpha_composite(region, overlay)
+
+        # Draw the text
+        draw = pilImageDraw.ImageDraw(region)
+        for (text_x, text_y), (line, _) in zip(positions, lines):
+            draw.text((text_x - left, text_y - top), line, font=font, fill=text_fill)
+
+        # Copy rather than paste into the image we were given, which may be
+        # the one the file was opened as
         img = img.convert('RGB')
-        img.save(os.path.join(desktop.download_directory, self.filename),
-                 "JPEG", quality=85)
+        img.paste(region.convert('RGB'), (left, top))
+        return img
+
+    def imprint_title(self, desktop):
+        self._ensure_pil_available('imprint_position')
+        self.transform(desktop, [self.imprint])
+
+
+def _fontconfig_cache_mtime():
+    mtimes = [os.path.getmtime(os.path.expanduser(d))
+              for d in FONTCONFIG_CACHE_DIRECTORIES
+              if os.path.isdir(os.path.expanduser(d))]
+    return max(mtimes) if mtimes else None
+
+
+class FontResolver(object):
+    """Resolves font names to TrueType files and keeps the fonts it loaded
+    for the life of the process.
+
+    Listing the system fonts through fontconfig is slow when there are many
+    of them, so resolved paths are also saved to disk and reused for as long
+    as fontconfig's cache directories haven't changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._paths = {}
+        self._fonts = {}
+        self._system_fonts = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def __repr__(self):
+        return '<FontResolver {}, {} fonts>'.format(self.path, len(self._fonts))
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if data.get('fontconfig_mtime') == _fontconfig_cache_mtime():
+            self._paths = data.get('paths', {})
+
+    def _save(self):
+        _safe_makedirs(os.path.dirname(self.path))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'fontconfig_mtime': _fontconfig_cache_mtime(),
+                       'paths': self._paths}, f)
+        os.replace(tmp_path, self.path)
+
+    def resolve(self, name):
+        """The path of the first system font whose path contains `name`,
+        or of the last one if none does.
+        """
+        path = self._paths.get(name)
+        if path and os.path.exists(path):
+            return path
+        if self._system_fonts is None:
+            log(u"Listing system fonts", level=2)
+            self._system_fonts = fontconfig.query(lang='en')
+        path = None
+        for path in self._system_fonts:
+            if name in path:
+                break
+        if path is None:
+            return None
+        self._paths[name] = path
+        self._save()
+        return path
+
+    def get_font(self, name, size, default=DEFAULT_IMPRINT_FALLBACK_FONT):
+        with self._lock:
+            font = self._fonts.get((name, size))
+            if font is None:
+                try:
+                    path = self.resolve(name)
+                    if path is None:
+                        raise IOError(name)
+                    font = pilImageFont.truetype(path, size)
+                except IOError:
+                    warn("Cannot open font file {}.".format(name))
+                    font = pilImageFont.truetype(default, size)
+                self._fonts[(name, size)] = font
+            return font
+
+
+class TextLayout(object):
+    """Greedy word wrapping for a PIL font that measures each word once.
+
+    A line's width is the sum of the widths of its words and the spaces
+    between them. Kerning against the spaces can make that a little off, so
+    a line that comes out within a space's width of the limit is measured
+    whole before deciding whether the next word fits.
+    """
+
+    def __init__(self, font):
+        self.font = font
+        self.space_width = font.getlength(u' ')
+        ascent, descent = font.getmetrics()
+        self.line_height = ascent + descent
+        self._widths = {}
+
+    def word_width(self, word):
+        width = self._widths.get(word)
+        if width is None:
+            width = self._widths[word] = self.font.getlength(word)
+        return width
+
+    def wrap(self, text, maxwidth):
+        """Split `text` into lines no wider than `maxwidth` (a word that's
+        wider than that gets a line to itself) and return them as
+        (line, width) pairs.
+        """
+        lines = []
+        for paragraph in text.splitlines():
+            words = []
+            width = 0
+            for word in paragraph.split():
+                if not words:
+                    words, width = [word], self.word_width(word)
+                    continue
+                new_width = width + self.space_width + self.word_width(word)
+                if abs(new_width - maxwidth) <= self.space_width:
+                    new_width = self.font.getlength(u' '.join(words + [word]))
+                if new_width > maxwidth:
+                    lines.append(u' '.join(words))
+                    words, width = [word], self.word_width(word)
+                else:
+                    words.append(word)
+                    width = new_width
+            if words:
+                lines.append(u' '.join(words))
+        return [(line, self.font.getlength(line)) for line in lines]
+
+
+def get_text_layout(font):
+    """The `TextLayout` of a font, which keeps its measurements for as long
+    as the font is around.
+    """
+    with _TEXT_LAYOUTS_LOCK:
+        layout = _TEXT_LAYOUTS.get(font)
+        if layout is None:
+            layout = _TEXT_LAYOUTS[font] = TextLayout(font)
+        return layout
+
+
+def get_font_resolver():
+    global _FONT_RESOLVER
+    with _FONT_RESOLVER_LOCK:
+        if _FONT_RESOLVER is None:
+            directory = os.path.expanduser(get_cache_directory())
+            _FONT_RESOLVER = FontResolver(os.path.join(directory, DEFAULT_FONT_CACHE_FILENAME))
+        return _FONT_RESOLVER
 
 
 class Subreddit(object):
-    def __init__(self, desktop, name, sort='top', limit=100, timeframe='month'):
+    def __init__(self, desktop, name, sort='top', limit=DEFAULT_SUBREDDIT_LIMIT,
+                 timeframe='month', weight=1.0):
         self.desktop = desktop
         self.name = name
+        try:
+            self.weight = max(0.0, float(weight))
+        except (TypeError, ValueError):
+            warn(u"Invalid weight specified for subreddit '{}': {}, using 1.0".format(
+                name, weight))
+            self.weight = 1.0
         self.sort = sort
-        self.limit = limit
+        try:
+            self.limit = int(limit)
+        except (TypeError, ValueError):
+            log(u"Invalid limit specified for subreddit '{}': {}".format(name, limit))
+            self.limit = DEFAULT_SUBREDDIT_LIMIT
         self.timeframe = timeframe
 
-    def fetch_images(self):
+    @property
+    def key(self):
+        """Identifies the listing, subreddits with the same key fetch the
+        same images.
+        """
+        return (self.name.lower(), self.sort, str(self.limit), self.timeframe)
+
+    @property
+    def ttl(self):
+        """How long this listing may be served from the cache"""
+        for key in ('{}:{}'.format(self.sort, self.timeframe), self.sort):
+            if key in DEFAULT_LISTING_TTLS:
+                return DEFAULT_LISTING_TTLS[key]
+        return DEFAULT_LISTING_TTL
+
+    def _listing_url(self, limit, after=None):
         url = 'http://reddit.com/r/{subreddit}/{sort}.json?t={timeframe}&limit={limit}'
         url = url.format(subreddit=self.name,
                          sort=self.sort,
                          timeframe=self.timeframe,
-                         limit=self.limit)
-
-        try:
-            log(url)
-            response = _urlopen(url)
-        except URLOpenError:
-            warn("error fetching images from subreddit '{0}',"
-                 " skipping...".format(self.name))
-            return []
-
+                         limit=limit)
+        if after:
+            url += '&after={}'.format(after)
+        return url
+
+    def iter_listing(self):
+        """Yield the listing one page of posts at a time.
+
+        Pages are followed using Reddit's `after` cursor until `limit` posts
+        were seen. Posts older than `max_age` hours or scoring below
+        `min_score` are dropped, and when the sort order guarantees that no
+        later post can pass the cutoff we stop paging early.
+        """
+        remaining = self.limit
+        after = None
+        max_age = get_max_age()
+        min_score = get_min_score()
+        oldest = time.time() - max_age * 60 * 60 if max_age else None
+
+        while remaining > 0:
+            url = self._listing_url(min(remaining, DEFAULT_LISTING_PAGE_SIZE), after)
+            try:
+                log(url)
+                data = json.loads(cache.get_cache().fetch(url, self.ttl))
+            except (TransportError, ValueError) as e:
+                log(e)
+                warn("error fetching images from subreddit '{0}',"
+                     " skipping...".format(self.name))
+                return
+
+            children = data['data']['children'][:remaining]
+            if not children:
+                return
+            remaining -= len(children)
+            after = data['data'].get('after')
+
+            page = []
+            exhausted = False
+            for child in children:
+                post = child['data']
+                if oldest and post.get('created_utc', 0) < oldest:
+                    exhausted = exhausted or self.sort == 'new'
+                    continue
+                if min_score is not None and post.get('score', 0) < min_score:
+                    exhausted = exhausted or self.sort == 'top'
+                    continue
+                page.append(post)
+
+            if page:
+                yield page
+            if exhausted or not after:
+                return
+
+    def _collect_started(self, post, started):
+        started.append(time.monotonic())
+        return self._collect_urls(post)
+
+    def iter_images(self):
+        """Yield candidate images as soon as their post is resolved.
+
+        Posts are resolved on a pool of `listing_workers` threads while the
+        next listing page is being fetched. A post that takes longer than
+        `post_timeout` seconds is abandoned, and once `listing_deadline`
+        seconds have passed whatever is still outstanding is dropped.
+        """
+        post_timeout = get_post_timeout()
+        listing_deadline = get_listing_deadline()
+        deadline = time.monotonic() + listing_deadline if listing_deadline else None
+
+        listing = self.iter_listing()
+        listing_done = False
+        # future -> (post, [start time once it's running])
+        pending = {}
+        pool = ThreadPoolExecutor(max_workers=get_listing_workers())
         try:
-            data = json.loads(response.read())
+            while not listing_done or pending:
+                if not listing_done:
+                    page = next(listing, None)
+                    if page is None:
+                        listing_done = True
+                    for post in page or ():
+                        started = []
+                        future = pool.submit(self._collect_started, post, started)
+                        pending[future] = (post, started)
+
+                # Hand out whatever is resolved; only block once there are
+                # no more pages to fetch in the meantime
+                done, _ = wait(pending, timeout=0.25 if listing_done else 0,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    del pending[future]
+                    try:
+                        for image in future.result():
+                            yield image
+                    except Exception as e:
+                        log('Failed to load data {}'.format(e))
+
+                now = time.monotonic()
+                for future, (post, started) in list(pending.items()):
+                    if started and now - started[0] > post_timeout:
+                        log(u"Timed out resolving '{}'".format(post.get('url')))
+                        del pending[future]
+
+                if deadline and now > deadline:
+                    log(u"Listing deadline reached for r/{}, dropping {} posts".format(
+                        self.name, len(pending)))
+                    break
         finally:
-            response.close()
+            listing.close()
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
 
-        images = []
-        
-        with ThreadPoolExecutor(max_workers=5) as pool:
-            futures = {pool.submit(self._collect_urls, child['data']): child for child in data['data']['children']}
-            for future in as_completed(futures):
-                try:
-                    data = future.result()
-                    images = [*images, *data]
-                except Exception as e:
-                    log('Failed to load data {}'.format(e))
-        
+    def fetch_images(self):
+        images = list(self.iter_images())
         log('Count of images: {}'.format(len(images)))
         return images
     
@@ -953,41 +2867,7 @@ class Subreddit(object):
         images = []
         try:
             if 'imgur' in data['url']:
-                imgur_url = data['url']
-                if ImgurWallpaper.is_single_image(imgur_url):
-                    image_data = ImgurWallpaper.load_from_api(imgur_url)
-                    if image_data:
-                        image_data['url'] = image_data['link']
-                        image_data['score'] = image_data['views']
-
-                        image = Image(image_data['width'],
-                                image_data['height'],
-                                image_data['url'],
-                                image_data['thumbnail_link'],
-                                data['title'],
-                                int(data['score']),
-                                image_id=image_data['id'])
-                        log('Single Image: {}'.format(image.full_title))
-                        images.append(image)
-                    else:
-                        log('URL returns null data : {}'.format(imgur_url))
-                else:
-                    # Imgur Album is found.
-                    for image_data in ImgurWallpaper.load_imgur_album(imgur_url):
-                        if image_data:
-                            image_data['url'] = image_data['link']
-                            image_data['score'] = image_data['views']
-                            image = Image(image_data['width'],
-                                    image_data['height'],
-                                    image_data['url'],
-                                    image_data['thumbnail_link'],
-                                    data['title'],
-                                    int(data['score']),
-                                image_id=image_data['id'])
-                            log('Album Image: {}'.format(image.full_title))
-                            images.append(image)
-                        else:
-                            log('URL returns null data : {}'.format(imgur_url.full_title))
+                images.extend(self._collect_imgur_urls(data))
             else:
                 image_data = data['preview']['images'][0]['source']
                 image = Image(image_data['width'],
@@ -995,7 +2875,10 @@ class Subreddit(object):
                         image_data['url'],
                         data['thumbnail'],
                         data['title'],
-                        int(data['score']))
+                        int(data['score']),
+                        image_id=data['name'],
+                        created_utc=data.get('created_utc'),
+                        nsfw=bool(data.get('over_18')))
                 log('Reddit Image: {}'.format(image.full_title))
                 images.append(image)
         except Exception as e:
@@ -1003,6 +2886,45 @@ class Subreddit(object):
         
         return images
 
+    def _collect_imgur_urls(self, data):
+        imgur_url = data['url']
+        kind = ImgurWallpaper.classify(imgur_url)
+
+        # A direct link to the image file: Reddit's preview already tells us
+        # its size, so there's no need to ask the Imgur API at all
+        if kind == ImgurWallpaper.DIRECT and 'preview' in data:
+            image_data = data['preview']['images'][0]['source']
+            image = Image(image_data['width'],
+                          image_data['height'],
+                          imgur_url,
+                          data['thumbnail'],
+                          data['title'],
+                          int(data['score']),
+                          image_id=ImgurWallpaper._get_imgur_id(imgur_url),
+                          created_utc=data.get('created_utc'),
+                          nsfw=bool(data.get('over_18')))
+            log('Direct Image: {}'.format(image.full_title))
+            return [image]
+
+        images = []
+        for image_data in ImgurWallpaper.resolve(imgur_url):
+            image = Image(image_data['width'],
+                          image_data['height'],
+                          image_data['link'],
+                          image_data['thumbnail_link'],
+                          data['title'],
+                          int(data['score']),
+                          image_id=image_data['id'],
+                          created_utc=data.get('created_utc'),
+                          nsfw=bool(data.get('over_18') or image_data.get('nsfw')),
+                          file_size=image_data.get('size'))
+            log('{} Image: {}'.format(kind.capitalize(), image.full_title))
+            images.append(image)
+
+        if not images:
+            log('URL returns null data : {}'.format(imgur_url))
+        return images
+
     @classmethod
     def handle_dynamic_subreddit_seasonal(cls, token_parts):
         """Dynamic subreddit handlers mutate token_parts in order to trigger
@@ -1023,10 +2945,12 @@ class Subreddit(object):
             func = getattr(cls, handler_name)
             func(token_parts)
 
-        args = ('name', 'sort', 'limit', 'timeframe')
+        args = ('name', 'sort', 'limit', 'timeframe', 'weight')
         ddict = {}
         for arg, value in zip(args, token_parts):
-            ddict[arg] = value
+            # An empty field (e.g. 'CarPorn:top::week') keeps the default
+            if value or arg == 'name':
+                ddict[arg] = value
         return cls(desktop, **ddict)
 
     def __repr__(self):
@@ -1064,6 +2988,29 @@ def _read_config_file(desktops):
                 if tokens:
                     getattr(desktop.imprint_conf, funcname)(tokens)
 
+    def parse_scoring_options(desktop, section):
+        profile = desktop.scoring_profile
+        try:
+            tokens = [t.strip() for t in config.get(section, 'scoring_weights').split(',')]
+        except NoOptionError:
+            pass
+        else:
+            profile.set_weight_tokens([t for t in tokens if t])
+        try:
+            profile.set_min_resolution(config.get(section, 'min_resolution'))
+        except NoOptionError:
+            pass
+        try:
+            tokens = [t.strip() for t in config.get(section, 'aspect_band').split(':')]
+        except NoOptionError:
+            pass
+        else:
+            profile.set_aspect_band_tokens(tokens)
+        try:
+            profile.allow_nsfw = config.getboolean(section, 'allow_nsfw')
+        except NoOptionError:
+            pass
+
     config = ConfigParser()
     with open(path) as f:
         config.read_file(f)
@@ -1074,6 +3021,7 @@ def _read_config_file(desktops):
             section = 'default'
         parse_subreddit_tokens(desktop, section)
         parse_imprint_tokens(desktop, section)
+        parse_scoring_options(desktop, section)
 
     if 'default' in config.sections():
         try:
@@ -1098,6 +3046,121 @@ def _read_config_file(desktops):
             set_image_scaling(config.get('default', 'image_scaling'))
         except NoOptionError:
             pass
+        try:
+            subreddit_mode = config.get('default', 'subreddit_mode')
+        except NoOptionError:
+            pass
+        else:
+            if subreddit_mode:
+                set_subreddit_mode(subreddit_mode)
+        try:
+            set_listing_workers(config.getint('default', 'listing_workers'))
+        except NoOptionError:
+            pass
+        try:
+            set_post_timeout(config.getint('default', 'post_timeout'))
+        except NoOptionError:
+            pass
+        try:
+            set_listing_deadline(config.getint('default', 'listing_deadline'))
+        except NoOptionError:
+            pass
+        try:
+            set_probe_images(config.getboolean('default', 'probe_images'))
+        except NoOptionError:
+            pass
+        try:
+            set_max_download_size(config.getint('default', 'max_download_size'))
+        except NoOptionError:
+            pass
+        try:
+            set_near_duplicate_distance(config.getint('default', 'near_duplicate_distance'))
+        except NoOptionError:
+            pass
+        try:
+            set_keep_images(config.getint('default', 'keep_images'))
+        except NoOptionError:
+            pass
+        try:
+            resample_filter = config.get('default', 'resample_filter')
+        except NoOptionError:
+            pass
+        else:
+            if resample_filter in RESAMPLE_FILTERS:
+                set_resample_filter(resample_filter)
+            else:
+                warn(u"unknown resample_filter '{}', using {}".format(
+                    resample_filter, DEFAULT_RESAMPLE_FILTER))
+        try:
+            set_image_memory_budget(config.getint('default', 'image_memory_budget'))
+        except NoOptionError:
+            pass
+        for name, get_option in (('quality', config.getint),
+                                 ('optimize', config.getboolean),
+                                 ('progressive', config.getboolean),
+                                 ('subsampling', config.get)):
+            try:
+                set_jpeg_option(name, get_option('default', 'jpeg_' + name))
+            except NoOptionError:
+                pass
+        try:
+            set_max_library_size(config.getint('default', 'max_library_size'))
+        except NoOptionError:
+            pass
+        try:
+            hash_algorithm = config.get('default', 'hash_algorithm')
+        except NoOptionError:
+            pass
+        else:
+            # shake_* digests need a length, they're no use here
+            if hash_algorithm in hashlib.algorithms_available \
+                    and not hash_algorithm.startswith('shake_'):
+                set_hash_algorithm(hash_algorithm)
+            else:
+                warn(u"unknown hash_algorithm '{}', using {}".format(
+                    hash_algorithm, DEFAULT_HASH_ALGORITHM))
+        try:
+            assignment = config.get('default', 'assignment')
+        except NoOptionError:
+            pass
+        else:
+            if assignment:
+                set_assignment(assignment)
+        try:
+            set_max_age(config.getint('default', 'max_age'))
+        except NoOptionError:
+            pass
+        try:
+            set_min_score(config.getint('default', 'min_score'))
+        except NoOptionError:
+            pass
+        try:
+            set_download_workers(config.getint('default', 'download_workers'))
+        except NoOptionError:
+            pass
+        try:
+            set_process_workers(config.getint('default', 'process_workers'))
+        except NoOptionError:
+            pass
+        try:
+            set_http_timeout(config.getint('default', 'timeout'))
+        except NoOptionError:
+            pass
+        try:
+            set_http_connections_per_host(config.getint('default', 'connections_per_host'))
+        except NoOptionError:
+            pass
+        try:
+            cache_directory = config.get('default', 'cache_directory')
+        except NoOptionError:
+            pass
+        else:
+            if cache_directory:
+                set_cache_directory(cache_directory)
+        try:
+            set_cache_size(config.getint('default', 'cache_size'))
+        except NoOptionError:
+            pass
         try:
             set_background_setting(config.get('default', 'background_setting'))
         except NoOptionError:
@@ -1122,6 +3185,27 @@ def _handle_cli_options(desktops):
                              " images, it doesn't set the background)")
     parser.add_argument('--download-directory',
                         help='directory to use to store images')
+    parser.add_argument('--merge-subreddits',
+                        action='store_true',
+                        help='rank images from all subreddits together instead'
+                             ' of picking one subreddit at random')
+    parser.add_argument('--joint-assignment',
+                        action='store_true',
+                        help='choose the images for all desktops together so'
+                             ' that no two desktops get the same image')
+    parser.add_argument('--max-age', type=int,
+                        help='ignore posts older than this many hours')
+    parser.add_argument('--min-score', type=int,
+                        help='ignore posts with a lower Reddit score')
+    parser.add_argument('--download-workers', type=int,
+                        help='number of images to download in parallel')
+    parser.add_argument('--process-workers', type=int,
+                        help='number of images to fit and imprint in parallel')
+    parser.add_argument('--timeout', type=int,
+                        help='network timeout in seconds')
+    parser.add_argument('--offline',
+                        action='store_true',
+                        help='only use cached listings and already downloaded images')
     parser.add_argument('--what',
                         action='store_true',
                         help='display what images are downloaded for each desktop')
@@ -1144,6 +3228,7 @@ def _handle_cli_options(desktops):
 
     set_verbosity(args.verbose)
     set_what(args.what)
+    set_offline(args.offline)
 
     if args.image_count is not None:
         set_image_count(args.image_count)
@@ -1151,6 +3236,27 @@ def _handle_cli_options(desktops):
     if args.download_directory:
         set_download_directory(args.download_directory)
 
+    if args.merge_subreddits:
+        set_subreddit_mode('merged')
+
+    if args.joint_assignment:
+        set_assignment('joint')
+
+    if args.max_age is not None:
+        set_max_age(args.max_age)
+
+    if args.min_score is not None:
+        set_min_score(args.min_score)
+
+    if args.download_workers is not None:
+        set_download_workers(args.download_workers)
+
+    if args.process_workers is not None:
+        set_process_workers(args.process_workers)
+
+    if args.timeout:
+        set_http_timeout(args.timeout)
+
     if args.background_setting:
         set_background_setting(args.background_setting)
 
@@ -1174,8 +3280,9 @@ def _handle_cli_options(desktops):
 def show_whats_downloaded(desktops):
     for desktop in desktops:
         print("Desktop {}".format(desktop.num))
-        for filename in desktop.downloaded_images.keys():
-            print("\t{}".format(filename))
+        downloaded_images = desktop.downloaded_images
+        for filename in sorted(downloaded_images, key=downloaded_images.get):
+            print(u"\t{} ({})".format(downloaded_images[filename], filename))
 
 
 def get_desktop_config():
@@ -1190,6 +3297,8 @@ def get_desktop_config():
 
 def main():
     desktops = get_desktop_config()
+    _configure_transport()
+    _configure_cache()
 
     if get_what():
         show_whats_downloaded(desktops)
@@ -1197,21 +3306,37 @@ def main():
 
     image_count = get_image_count()
 
-    _clear_download_directory(desktops)
+    # Desktops often share subreddits, so plan the whole run first and fetch
+    # each distinct listing only once
+    plan = [(desktop, desktop.choose_subreddits()) for desktop in desktops]
+    listings = _fetch_listings([s for _, subreddits in plan for s in subreddits])
 
-    for desktop in desktops:
-        if image_count > 0:
-            # Download-only mode (downloads multiple images, but doesn't set
-            # the background because we'll let the OS's native
-            # background-setting utility handle it)
-            desktop.fetch_backgrounds(image_count)
-            log(u"Skipping setting background")
-        else:
-            # Set-background mode (download the best image, and set the
-            # background ourselves)
-            images = desktop.fetch_backgrounds(1)
-            if images:
+    # Download-only mode (downloads multiple images, but doesn't set the
+    # background because we'll let the OS's native background-setting utility
+    # handle it) or set-background mode (download the best image, and set the
+    # background ourselves)
+    download_count = image_count if image_count > 0 else 1
+
+    if get_assignment() == 'joint':
+        assignments = [(desktop, candidates, None) for desktop, candidates
+                       in _assign_jointly(plan, listings, download_count)]
+    else:
+        assignments = []
+        for desktop, subreddits in plan:
+            chooser = desktop.get_chooser(subreddits, listings)
+            assignments.append((desktop, chooser.iter_best(), chooser.requeue))
+
+    with SharedDownloads() as shared_downloads:
+        for desktop, candidates, requeue in assignments:
+            images = desktop.download_backgrounds(candidates, download_count,
+                                                  shared_downloads=shared_downloads,
+                                                  requeue=requeue)
+            if image_count > 0:
+                log(u"Skipping setting background")
+            elif images:
                 desktop.set_background(images[0])
+            desktop.prune_downloads(
+                keep=[os.path.basename(image.file_path) for image in images])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,269 @@
+"""
+Shared HTTP transport.
+
+Reddit listings, Imgur API calls and image downloads all go through the
+module-level transport returned by `get_transport()`. It keeps idle
+connections around per host so that successive requests reuse them instead
+of paying for a new TCP (and TLS) handshake each time, caps the number of
+connections opened to any one host, applies a timeout to every socket
+operation and transparently decodes gzip'd responses.
+"""
+import http.client
+import socket
+import ssl
+import threading
+import urllib.parse as urlparse
+import zlib
+
+DEFAULT_USER_AGENT = "Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11"
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+DEFAULT_MAX_REDIRECTS = 5
+
+# Errors that mean a pooled keep-alive connection was closed by the server
+# while it sat idle; the request is retried once on a fresh connection
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected,
+                            http.client.BadStatusLine,
+                            ConnectionResetError,
+                            BrokenPipeError)
+
+_TRANSPORT = None
+_TRANSPORT_LOCK = threading.Lock()
+
+
+class TransportError(Exception):
+    pass
+
+
+class HTTPStatusError(TransportError):
+    def __init__(self, url, status, reason=''):
+        super(HTTPStatusError, self).__init__(
+            'HTTP {} {} for {}'.format(status, reason, url))
+        self.url = url
+        self.status = status
+
+
+class Response(object):
+    """A response whose connection goes back to the pool once it's closed."""
+
+    def __init__(self, host_pool, conn, raw, url):
+        self._host_pool = host_pool
+        self._conn = conn
+        self._raw = raw
+        self._released = False
+        self.url = url
+        self.status = raw.status
+        self.reason = raw.reason
+        self.headers = raw.headers
+        if (raw.getheader('Content-Encoding') or '').lower() == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def getheader(self, name, default=None):
+        return self._raw.getheader(name, default)
+
+    def _read_raw(self, amt):
+        try:
+            return self._raw.read(amt)
+        except (socket.error, http.client.HTTPException) as e:
+            self.close()
+            raise TransportError('error reading {}: {}'.format(self.url, e))
+
+    def read(self, amt=None):
+        if self._decompressor is None:
+            data = self._read_raw(amt)
+        elif amt is None:
+            data = self._decompressor.decompress(self._read_raw(None))
+            data += self._decompressor.flush()
+        else:
+            # The decompressor may buffer a whole chunk, keep going until it
+            # produces output or the body is exhausted
+            data = b''
+            while not data:
+                chunk = self._read_raw(amt)
+                if not chunk:
+                    data = self._decompressor.flush()
+                    break
+                data = self._decompressor.decompress(chunk)
+        if self._raw.isclosed():
+            self.close()
+        return data
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        # A connection can only be reused once its response has been read
+        # to the end
+        reuse = self._raw.isclosed() and not self._raw.will_close
+        if not reuse:
+            self._raw.close()
+        self._host_pool.release(self._conn, reuse)
+
+
+class _HostPool(object):
+    """Idle connections to a single host, bounded by a semaphore."""
+
+    def __init__(self, scheme, host, port, max_connections, timeout, ssl_context):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self.connections_opened = 0
+
+    def _new_connection(self):
+        self.connections_opened += 1
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port,
+                                               timeout=self.timeout,
+                                               context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+
+    def acquire(self, fresh=False):
+        """Return (connection, reused)"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TransportError('timed out waiting for a connection to {}'.format(self.host))
+        if not fresh:
+            with self._lock:
+                if self._idle:
+                    return self._idle.pop(), True
+        with self._lock:
+            return self._new_connection(), False
+
+    def release(self, conn, reuse):
+        if reuse:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+
+class HTTPTransport(object):
+    def __init__(self, timeout=DEFAULT_TIMEOUT,
+                 max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 user_agent=DEFAULT_USER_AGENT):
+        self.timeout = timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.user_agent = user_agent
+        self._ssl_context = ssl.create_default_context()
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<HTTPTransport {} hosts>'.format(len(self._pools))
+
+    def _get_host_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = _HostPool(scheme, host, port,
+                                 self.max_connections_per_host,
+                                 self.timeout,
+                                 self._ssl_context)
+                self._pools[key] = pool
+            return pool
+
+    @property
+    def connections_opened(self):
+        return sum(p.connections_opened for p in self._pools.values())
+
+    def _send(self, url, method, headers):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise TransportError('unsupported URL {}'.format(url))
+        host_pool = self._get_host_pool(parts.scheme, parts.hostname, parts.port)
+        target = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        fresh = False
+        while True:
+            conn, reused = host_pool.acquire(fresh=fresh)
+            try:
+                conn.request(method, target, headers=headers)
+                raw = conn.getresponse()
+            except _STALE_CONNECTION_ERRORS as e:
+                host_pool.release(conn, False)
+                if reused:
+                    fresh = True
+                    continue
+                raise TransportError('error requesting {}: {}'.format(url, e))
+            except (socket.error, http.client.HTTPException) as e:
+                host_pool.release(conn, False)
+                raise TransportError('error requesting {}: {}'.format(url, e))
+            return Response(host_pool, conn, raw, url)
+
+    def request(self, url, headers=None, method='GET', gzip=True):
+        """Issue a request and return the `Response`, following redirects.
+
+        Statuses of 400 and above raise `HTTPStatusError`; anything else
+        (including 206 and 304) is returned to the caller, who must close the
+        response so its connection can be reused.
+        """
+        request_headers = {'User-Agent': self.user_agent}
+        if gzip:
+            request_headers['Accept-Encoding'] = 'gzip'
+        request_headers.update(headers or {})
+
+        for _ in range(DEFAULT_MAX_REDIRECTS + 1):
+            response = self._send(url, method, request_headers)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                response.close()
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status >= 400:
+                response.close()
+                raise HTTPStatusError(url, response.status, response.reason)
+            return response
+        raise TransportError('too many redirects for {}'.format(url))
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools = {}
+
+
+def configure(timeout=None, max_connections_per_host=None, user_agent=None):
+    """Replace the shared transport with one using the given settings."""
+    global _TRANSPORT
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is not None:
+            _TRANSPORT.close()
+        _TRANSPORT = HTTPTransport(
+            timeout=timeout or DEFAULT_TIMEOUT,
+            max_connections_per_host=max_connections_per_host or DEFAULT_MAX_CONNECTIONS_PER_HOST,
+            user_agent=user_agent or DEFAULT_USER_AGENT)
+    return _TRANSPORT
+
+
+def get_transport():
+    global _TRANSPORT
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is None:
+            _TRANSPORT = HTTPTransport()
+        return _TRANSPORT
+
+
+def urlopen(url, headers=None, gzip=True):
+    return get_transport().request(url, headers=headers, gzip=gzip)
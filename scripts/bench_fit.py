@@ -0,0 +1,67 @@
+"""
+Benchmark fitting large JPEGs to a desktop.
+
+Every JPEG in a folder is copied to a scratch directory and fit to a
+`--width`x`--height` desktop with `Image.fit_to_desktop`. Prints the CPU
+time per image and the peak RSS of the process. Peak RSS covers the whole
+process, so run the script once per configuration, and from a checkout of
+an older version to compare against it.
+
+    python scripts/bench_fit.py FOLDER [--width 1920] [--height 1080]
+                                [--filter bicubic]
+"""
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from background import reddit_background  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('folder', help='folder of sample JPEGs')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--filter', help='resample_filter to use, if supported')
+    args = parser.parse_args()
+
+    if args.filter:
+        reddit_background.set_resample_filter(args.filter)
+
+    sources = sorted(os.path.join(args.folder, name) for name in os.listdir(args.folder)
+                     if name.lower().endswith(('.jpg', '.jpeg')))
+    if not sources:
+        parser.error('no JPEGs in {}'.format(args.folder))
+
+    desktop = reddit_background.Desktop(1, args.width, args.height)
+    scratch = tempfile.mkdtemp(prefix='bench-fit-')
+    elapsed = 0.0
+    try:
+        for i, source in enumerate(sources):
+            path = os.path.join(scratch, '{}.jpg'.format(i))
+            shutil.copyfile(source, path)
+            image = reddit_background.Image(
+                args.width, args.height, 'https://i.example.com/{}.jpg'.format(i), '',
+                'Image {}'.format(i), 1)
+            image.file_path = path
+            start = time.process_time()
+            image.fit_to_desktop(desktop)
+            elapsed += time.process_time() - start
+    finally:
+        shutil.rmtree(scratch)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    print('{} images  {:.0f} ms CPU per image  {:.0f} MB peak RSS'.format(
+        len(sources), elapsed * 1000 / len(sources), peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
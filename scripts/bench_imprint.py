@@ -0,0 +1,139 @@
+"""
+Benchmark imprinting a title on a 4K image.
+
+Times `Image.imprint`, which composites the title box over just the region
+it covers, against compositing over the full frame the way it used to,
+on a `--width`x`--height` image (3840x2160 by default). Before timing, it
+checks on `--checks` random positions, sizes, transparencies and titles
+that both produce pixel-identical output.
+
+    python scripts/bench_imprint.py [--width 3840] [--height 2160]
+                                    [--repeat 21] [--checks 36] [--seed 0]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from PIL import Image as pilImage  # noqa: E402
+from PIL import ImageChops as pilImageChops  # noqa: E402
+from PIL import ImageColor as pilImageColor  # noqa: E402
+from PIL import ImageDraw as pilImageDraw  # noqa: E402
+
+from background import reddit_background  # noqa: E402
+
+TITLES = (
+    'Short',
+    'Perth, Western Australia, from Elizabeth Quay [5376x3024]',
+    'A much longer title that will need to wrap over a few lines on narrower '
+    'boxes, with descenders: gjpqy [3840x2160]',
+)
+
+
+def imprint_full_frame(image, img, desktop):
+    """The title box composited over the whole image"""
+    conf = desktop.imprint_conf
+    if conf.box_width.strip().lower() == 'auto':
+        maxwidth = desktop.width
+    else:
+        maxwidth = int(conf.box_width)
+
+    font = image._get_imprint_font(desktop)
+    layout = reddit_background.get_text_layout(font)
+    lines = layout.wrap(image.full_title, maxwidth)
+    maxwidth = max(width for _, width in lines)
+    lineheight = layout.line_height
+    maxheight = len(lines) * lineheight
+
+    if 'left' in conf.position_tokens:
+        x = conf.margin
+    elif 'right' in conf.position_tokens:
+        x = max(conf.margin, img.width - maxwidth - conf.margin)
+    else:
+        x = max(conf.margin, (img.width - maxwidth) / 2)
+    if 'top' in conf.position_tokens:
+        y = conf.margin
+    elif 'bottom' in conf.position_tokens:
+        y = max(conf.margin, img.height - maxheight - conf.margin)
+    else:
+        y = max(conf.margin, (img.height - maxheight) / 2)
+
+    text_fill = pilImageColor.getrgb(conf.font_color)
+    if len(text_fill) != 3:
+        text_fill = (255, 229, 204)
+
+    img = img.convert('RGBA')
+    overlay = pilImage.new('RGBA', img.size)
+    pilImageDraw.ImageDraw(overlay).rectangle(
+        (x - conf.padding, y - conf.padding,
+         x + maxwidth + conf.padding, y + maxheight + conf.padding),
+        fill=(0, 0, 0, int(255 * conf.transparency / 100.0)))
+    img = pilImage.alpha_composite(img, overlay)
+    draw = pilImageDraw.ImageDraw(img)
+    for i, (line, _) in enumerate(lines):
+        draw.text((x, y + i * lineheight), line, font=font, fill=text_fill)
+    return img.convert('RGB')
+
+
+def make_source(width, height):
+    noise = [pilImage.effect_noise((width, height), sigma) for sigma in (40, 60, 80)]
+    return pilImage.merge('RGB', noise)
+
+
+def configure(desktop, rand):
+    conf = desktop.imprint_conf
+    conf.position_tokens = [rand.choice(['top', 'bottom', 'middle']),
+                            rand.choice(['left', 'right', 'center'])]
+    conf.margin = rand.choice([0, 8, 40])
+    conf.padding = rand.choice([0, 5, 40, 60])
+    conf.font_size = rand.choice([20, 50, 90])
+    conf.transparency = rand.choice([0, 40, 100])
+    conf.box_width = rand.choice(['auto', '300', '900'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--width', type=int, default=3840)
+    parser.add_argument('--height', type=int, default=2160)
+    parser.add_argument('--repeat', type=int, default=21, help='runs to take the best of')
+    parser.add_argument('--checks', type=int, default=36,
+                        help='random configurations to compare')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    source = make_source(args.width, args.height)
+    desktop = reddit_background.Desktop(1, args.width, args.height)
+
+    identical = 0
+    for _ in range(args.checks):
+        configure(desktop, rand)
+        image = reddit_background.Image(args.width, args.height,
+                                        'https://i.example.com/image.jpg', '',
+                                        rand.choice(TITLES), 1)
+        region = image.imprint(source.copy(), desktop)
+        full_frame = imprint_full_frame(image, source.copy(), desktop)
+        if pilImageChops.difference(region, full_frame).getbbox() is None:
+            identical += 1
+    print('pixel-identical: {}/{}'.format(identical, args.checks))
+
+    desktop = reddit_background.Desktop(1, args.width, args.height)
+    desktop.imprint_conf.position_tokens = ['bottom', 'left']
+    image = reddit_background.Image(args.width, args.height,
+                                    'https://i.example.com/image.jpg', '', TITLES[1], 1)
+    for name, imprint in (('full frame', lambda img: imprint_full_frame(image, img, desktop)),
+                          ('region', lambda img: image.imprint(img, desktop))):
+        times = []
+        for _ in range(args.repeat):
+            img = source.copy()
+            start = time.process_time()
+            imprint(img)
+            times.append(time.process_time() - start)
+        print('{:<11} {:6.1f} ms'.format(name, min(times) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark resolving a large subreddit listing.
+
+A synthetic listing of `--posts` posts is served from memory in pages of
+100, each page taking `--page-delay` ms to fetch and each post
+`--post-delay` ms to resolve, with one post hanging for `--hang` seconds
+(like a stuck Imgur lookup). Prints how long it took until the first image
+was yielded and until the whole listing was read. Run the script from a
+checkout of an older version to compare against it.
+
+    python scripts/bench_listing.py [--posts 1000] [--page-delay 20]
+                                    [--post-delay 2] [--hang 5]
+                                    [--post-timeout 1]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.parse as urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from background import cache  # noqa: E402
+from background import reddit_background  # noqa: E402
+
+
+class SyntheticListing(object):
+    """Stands in for the response cache, serving pages of fake posts"""
+
+    def __init__(self, posts, page_delay):
+        self.posts = posts
+        self.page_delay = page_delay
+
+    def _post(self, num):
+        url = 'https://i.example.com/{}.jpg'.format(num)
+        return {'kind': 't3',
+                'data': {'url': url,
+                         'preview': {'images': [{'source': {'width': 1920,
+                                                            'height': 1080,
+                                                            'url': url}}]},
+                         'thumbnail': '',
+                         'title': 'Post {}'.format(num),
+                         'score': num,
+                         'name': 't3_{}'.format(num),
+                         'created_utc': time.time()}}
+
+    def fetch(self, url, ttl, headers=None):
+        time.sleep(self.page_delay)
+        query = urlparse.parse_qs(urlparse.urlsplit(url).query)
+        start = int(query.get('after', ['t3_-1'])[0][3:]) + 1
+        limit = int(query.get('limit', ['100'])[0])
+        end = min(start + limit, self.posts)
+        children = [self._post(num) for num in range(start, end)]
+        after = 't3_{}'.format(end - 1) if end < self.posts else None
+        return json.dumps({'data': {'children': children, 'after': after}}).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--page-delay', type=float, default=20, help='ms per page')
+    parser.add_argument('--post-delay', type=float, default=2, help='ms per post')
+    parser.add_argument('--hang', type=float, default=5, help='seconds the slow post takes')
+    parser.add_argument('--post-timeout', type=int, default=1,
+                        help='post_timeout, if supported')
+    args = parser.parse_args()
+
+    listing = SyntheticListing(args.posts, args.page_delay / 1000.0)
+    cache.get_cache = lambda: listing
+    if hasattr(reddit_background, 'set_post_timeout'):
+        reddit_background.set_post_timeout(args.post_timeout)
+
+    collect_urls = reddit_background.Subreddit._collect_urls
+    hanging_post = 't3_{}'.format(args.posts // 2)
+
+    def slow_collect_urls(self, data):
+        time.sleep(args.hang if data['name'] == hanging_post else args.post_delay / 1000.0)
+        return collect_urls(self, data)
+
+    reddit_background.Subreddit._collect_urls = slow_collect_urls
+
+    subreddit = reddit_background.Subreddit(None, 'bench', limit=args.posts)
+    images = getattr(subreddit, 'iter_images', subreddit.fetch_images)
+    start = time.perf_counter()
+    first = None
+    count = 0
+    for _ in images():
+        if first is None:
+            first = time.perf_counter() - start
+        count += 1
+    elapsed = time.perf_counter() - start
+    print('{} images  first after {:.0f} ms  all after {:.2f} s'.format(
+        count, (first or 0) * 1000, elapsed))
+
+
+if __name__ == '__main__':
+    main()
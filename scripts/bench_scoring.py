@@ -0,0 +1,64 @@
+"""
+Benchmark ranking a large pool of candidates with the bestmatch chooser.
+
+Builds `--count` random candidates and times
+`BestMatchImageChooser.sort()` on them, with NumPy when it's importable and
+with the pure-Python fallback. To compare against an older version, run
+the script from a checkout of that version; on versions without the
+fallback both lines time the same code.
+
+    python scripts/bench_scoring.py [--count 100000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from background import reddit_background  # noqa: E402
+
+
+def make_images(count, seed=0):
+    rand = random.Random(seed)
+    images = []
+    for i in range(count):
+        width = rand.randint(640, 7680)
+        height = rand.randint(480, 4320)
+        images.append(reddit_background.Image(
+            width, height, 'https://i.example.com/{}.jpg'.format(i), '',
+            'Image {}'.format(i), int(rand.paretovariate(1.2) * 10)))
+    return images
+
+
+def bench(name, desktop, images, repeat):
+    times = []
+    for _ in range(repeat):
+        chooser = reddit_background.BestMatchImageChooser(desktop, list(images))
+        start = time.perf_counter()
+        chooser.sort()
+        times.append(time.perf_counter() - start)
+    print('{:<8} {:8.1f} ms'.format(name, min(times) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=100000, help='candidates to rank')
+    parser.add_argument('--repeat', type=int, default=5, help='runs to take the best of')
+    args = parser.parse_args()
+
+    desktop = reddit_background.Desktop(1, 1920, 1080)
+    images = make_images(args.count)
+    numpy_available = getattr(reddit_background, 'numpy_available', False)
+    if numpy_available:
+        bench('numpy', desktop, images, args.repeat)
+    reddit_background.numpy_available = False
+    try:
+        bench('python', desktop, images, args.repeat)
+    finally:
+        reddit_background.numpy_available = numpy_available
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark the shared transport against a new connection per request.
+
+A file is served from a local HTTP/1.1 stand-in server and downloaded
+`--count` times, first with urllib.request (one connection per download,
+like the urlretrieve/build_opener code the transport replaced) and then
+through `background.transport`. Prints the best wall time of `--repeat`
+runs and the number of connections the server accepted in a run.
+
+    python scripts/bench_transport.py [--count 100] [--size 200] [--repeat 5]
+"""
+import argparse
+import http.server
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from background import transport  # noqa: E402
+
+
+def serve(body):
+    connections = [0]
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            connections[0] += 1
+            http.server.BaseHTTPRequestHandler.setup(self)
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, connections
+
+
+def bench(name, fetch, url, count, repeat, connections):
+    times = []
+    for _ in range(repeat):
+        # Every run starts without pooled connections
+        transport.get_transport().close()
+        connections[0] = 0
+        start = time.perf_counter()
+        for _ in range(count):
+            fetch(url)
+        times.append(time.perf_counter() - start)
+    print('{:<12} {:7.1f} ms  {:4d} connections'.format(
+        name, min(times) * 1000, connections[0]))
+
+
+def fetch_urllib(url):
+    with urllib.request.urlopen(url) as response:
+        response.read()
+
+
+def fetch_transport(url):
+    with transport.urlopen(url, gzip=False) as response:
+        while response.read(64 * 1024):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=100, help='downloads per run')
+    parser.add_argument('--size', type=int, default=200, help='file size in KB')
+    parser.add_argument('--repeat', type=int, default=5, help='runs to take the best of')
+    args = parser.parse_args()
+
+    server, connections = serve(os.urandom(args.size * 1024))
+    url = 'http://127.0.0.1:{}/image.jpg'.format(server.server_port)
+    try:
+        bench('urllib', fetch_urllib, url, args.count, args.repeat, connections)
+        bench('transport', fetch_transport, url, args.count, args.repeat, connections)
+    finally:
+        transport.get_transport().close()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()